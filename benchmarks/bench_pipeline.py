@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Benchmark the whole zdf2pdf() pipeline on synthetic forums, with images
+served by a local stub server, and record the time, peak memory, and
+throughput of every stage.
+
+Each corpus size is built in a process of its own so peak memory is that of
+the one run. Results are saved as JSON tagged with the git commit, so runs
+on different commits can be compared:
+
+Usage: python benchmarks/bench_pipeline.py [--sizes small,medium] [-o FILE]
+       python benchmarks/bench_pipeline.py --sections 5 --entries 50 --body 20
+       python benchmarks/bench_pipeline.py --compare OLD.json NEW.json
+"""
+from __future__ import unicode_literals
+import os, sys, time, random, shutil, struct, subprocess, tempfile, threading, zlib
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import simplejson as json
+
+# sections, entries per section, paragraphs per body, distinct images,
+# images per entry, pre blocks per entry, cross links per entry
+SIZES = {
+    'tiny':   dict(sections=2, entries=5, body=5, images=3, entry_images=1, pre=1, links=1),
+    'small':  dict(sections=5, entries=20, body=10, images=10, entry_images=2, pre=1, links=2),
+    'medium': dict(sections=10, entries=50, body=20, images=50, entry_images=3, pre=2, links=3),
+    'large':  dict(sections=20, entries=100, body=40, images=200, entry_images=4, pre=3, links=5),
+}
+
+WORDS = ('riak bucket vnode ring partition handoff sibling vector clock quorum '
+         'replica node cluster backend bitcask leveldb index search commit').split()
+
+def png(seed, width=120, height=80):
+    """
+    A small solid colour PNG, different for each seed.
+    """
+    def chunk(kind, data):
+        return (struct.pack(b'>I', len(data)) + kind + data +
+                struct.pack(b'>I', zlib.crc32(kind + data) & 0xffffffff))
+    color = struct.pack(b'BBB', seed * 37 % 256, seed * 91 % 256, seed * 53 % 256)
+    rows = b''.join(b'\x00' + color * width for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack(b'>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+def corpus(sections, entries, body, images, entry_images, pre, links, seed=0):
+    """
+    Entries for a synthetic document: sections of entries, each with body
+    paragraphs, images, <pre> blocks, and links to other entries.
+    """
+    rand = random.Random(seed)
+    ids = [1000 + i for i in range(sections * entries)]
+
+    def words(n):
+        return ' '.join(rand.choice(WORDS) for i in range(n))
+
+    tree = []
+    for s in range(sections):
+        topics = []
+        for e in range(entries):
+            topic_id = ids[s * entries + e]
+            parts = []
+            for p in range(body):
+                parts.append('<p>{}</p>'.format(words(60)))
+                if p == 1:
+                    parts.append('<p><span> </span></p><div>&nbsp;</div>')
+            for i in range(entry_images):
+                parts.insert(rand.randint(0, len(parts)),
+                             '<p><img src="/img/{}.png"/></p>'.format(rand.randrange(images)))
+            for i in range(pre):
+                parts.insert(rand.randint(0, len(parts)),
+                             '<pre>{}</pre>'.format(', '.join(words(1) for j in range(120))))
+            for i in range(links):
+                parts.insert(rand.randint(0, len(parts)),
+                             '<p>See <a href="/entries/{}-other">this</a>.</p>'.format(rand.choice(ids)))
+            topics.append({'id': topic_id,
+                           'title': 'Topic {} {}'.format(topic_id, words(3)),
+                           'body': ''.join(parts)})
+        tree.append({'section': 'Section {}'.format(s), 'id': s + 1,
+                     'body': '<p>{}</p>'.format(words(30)), 'topics': topics})
+    return tree
+
+def image_server():
+    """
+    Start a server of /img/N.png images on a free port in a thread. Returns
+    the server and its URL.
+    """
+    import BaseHTTPServer, SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            try:
+                seed = int(self.path.split('/')[-1].split('.')[0])
+            except ValueError:
+                self.send_error(404)
+                return
+            etag = '"{}"'.format(seed)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            data = png(seed)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+def options(work_dir, url, render_workers):
+    return {
+        'verbose': False, 'json_file': None, 'categories': None, 'forums': None,
+        'topics': None, 'run_section': None, 'list_zdf': None, 'style_file': None,
+        'output_file': os.path.join(work_dir, 'bench.pdf'), 'title': 'Benchmark',
+        'title_class': None, 'author': 'zdf2pdf', 'date': None, 'copyright': None,
+        'toc': True, 'toc_class': None, 'toc_title': 'Table of Contents',
+        'pre_width': 80, 'strip_empty': True, 'transforms': None, 'html_parser': None,
+        'fetch_workers': 4, 'render_workers': render_workers, 'incremental': False,
+        'attach_cache': os.path.join(work_dir, 'attach-cache'),
+        'attach_cache_size': 1024, 'attach_cache_age': 90, 'header': None,
+        'footer': '<div id="footer"><pdf:pagenumber/></div>',
+        'work_dir': work_dir, 'url': url,
+    }
+
+def run_case(params, render_workers, results):
+    # Runs in a process of its own
+    from zdf2pdf.zdf2pdf import zdf2pdf
+    from zdf2pdf.profiling import Profiler
+
+    server, url = image_server()
+    work_dir = tempfile.mkdtemp(prefix='zdf2pdf-bench-')
+    try:
+        entries = corpus(**params)
+        size = len(json.dumps(entries))
+        profiler = Profiler()
+        start = time.time()
+        zdf2pdf(entries, options(work_dir, url, render_workers), profiler)
+        seconds = time.time() - start
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir)
+
+    count = params['sections'] * params['entries']
+    stages = profiler.report()['stages']
+    for stage in stages:
+        stage['entries_per_second'] = count / stage['seconds'] if stage['seconds'] else None
+    results.put({'params': params, 'render_workers': render_workers,
+                 'entries': count, 'json_bytes': size, 'seconds': seconds,
+                 'entries_per_second': count / seconds,
+                 'peak_rss': profiler.report()['peak_rss'], 'stages': stages})
+
+def git_commit():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=root) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('ascii') + ('-dirty' if dirty else '')
+
+def case_name(case):
+    name = ','.join('{}={}'.format(k, case['params'][k]) for k in sorted(case['params']))
+    return '{} workers={}'.format(name, case['render_workers'])
+
+def compare(old_file, new_file):
+    with open(old_file) as infile:
+        old = json.load(infile)
+    with open(new_file) as infile:
+        new = json.load(infile)
+    print('{} -> {}'.format(old['commit'], new['commit']))
+
+    old_cases = dict((case_name(case), case) for case in old['cases'])
+    for case in new['cases']:
+        name = case_name(case)
+        print('\n' + name)
+        if name not in old_cases:
+            print('    not in {}'.format(old_file))
+            continue
+        before = dict((s['name'], s) for s in old_cases[name]['stages'])
+        print('    {:<20} {:>9} {:>9} {:>7} {:>9} {:>9}'.format(
+              'Stage', 'Old (s)', 'New (s)', 'Ratio', 'Old MB', 'New MB'))
+        rows = [(s['name'], before.get(s['name']), s) for s in case['stages']]
+        rows.append(('total', old_cases[name], case))
+        for stage, a, b in rows:
+            if a is None:
+                print('    {:<20} {:>9} {:>9.3f}'.format(stage, '-', b['seconds']))
+                continue
+            print('    {:<20} {:>9.3f} {:>9.3f} {:>7} {:>9.1f} {:>9.1f}'.format(
+                  stage, a['seconds'], b['seconds'],
+                  '{:.2f}'.format(b['seconds'] / a['seconds']) if a['seconds'] else '-',
+                  a['peak_rss'] / 1048576.0, b['peak_rss'] / 1048576.0))
+    return 0
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Benchmark the zdf2pdf pipeline.')
+    argp.add_argument('--sizes', default='small',
+        help='Comma separated corpus sizes: {} (default: small)'.format(
+             ', '.join(sorted(SIZES, key=lambda k: SIZES[k]['sections']))))
+    for k in ['sections', 'entries', 'body', 'images', 'entry_images', 'pre', 'links']:
+        argp.add_argument('--' + k.replace('_', '-'), type=int, dest=k,
+            help='Custom corpus {} instead of --sizes'.format(k.replace('_', ' ')))
+    argp.add_argument('--render-workers', type=int, default=1,
+        help='Render processes (default: 1)')
+    argp.add_argument('--repeat', type=int, default=1,
+        help='Runs of each size, the fastest is kept (default: 1)')
+    argp.add_argument('-o', dest='output',
+        help='Results file (default: benchmarks/results/COMMIT.json)')
+    argp.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two results files instead of running')
+    args = argp.parse_args(argv[1:])
+
+    if args.compare:
+        return compare(*args.compare)
+
+    custom = dict((k, getattr(args, k)) for k in SIZES['tiny'] if getattr(args, k) is not None)
+    if custom:
+        params = [dict(SIZES['small'], **custom)]
+    else:
+        params = [SIZES[size.strip()] for size in args.sizes.split(',')]
+
+    commit = git_commit()
+    cases = []
+    for p in params:
+        runs = []
+        for i in range(args.repeat):
+            results = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=run_case,
+                                           args=(p, args.render_workers, results))
+            proc.start()
+            runs.append(results.get())
+            proc.join()
+        case = min(runs, key=lambda r: r['seconds'])
+        cases.append(case)
+        print('{}: {} entries in {:.2f}s, {:.1f} entries/s, peak {:.1f} MB'.format(
+              case_name(case), case['entries'], case['seconds'],
+              case['entries_per_second'], case['peak_rss'] / 1048576.0))
+        for stage in case['stages']:
+            print('    {:<20} {:>9.3f}s {:>9.1f} MB'.format(
+                  stage['name'], stage['seconds'], stage['peak_rss'] / 1048576.0))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         'results', '{}.json'.format(commit or 'unknown'))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as outfile:
+        json.dump({'commit': commit, 'date': time.time(),
+                   'python': sys.version.split()[0], 'cases': cases},
+                  outfile, indent=2)
+    print('Saved {}'.format(output))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Benchmark wrap_pre on log dumps pasted into <pre> blocks, against the earlier
+PreWrapTransform, which patched textwrap.TextWrapper for the whole process
+and built up each block by repeated concatenation. Also checks that the two
+give the same text, and that blocks wrapped in several threads at once come
+out the same as when wrapped one at a time.
+
+Usage: python benchmarks/bench_pre_wrap.py
+"""
+from __future__ import unicode_literals
+import os, random, re, sys, textwrap, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bs4 import BeautifulSoup
+from zdf2pdf.zdf2pdf import wrap_pre
+
+def textwrap_pre(pre, width):
+    old_wordsep_simple_re = textwrap.TextWrapper.wordsep_simple_re
+    textwrap.TextWrapper.wordsep_simple_re = re.compile(r'(\s+|\,)')
+    w = textwrap.TextWrapper(width=width,
+            replace_whitespace=False, drop_whitespace=False,
+            break_on_hyphens=False, break_long_words=True)
+    pre_str = ''
+    for line in pre.get_text().splitlines():
+        pre_str += '\n'.join(w.wrap(line)) + '\n'
+    pre.string = pre_str
+    textwrap.TextWrapper.wordsep_simple_re = old_wordsep_simple_re
+
+def log_dump(lines, seed=0):
+    """
+    A log of lines lines, with stack traces, tab indented fields, and long
+    unbroken tokens.
+    """
+    rand = random.Random(seed)
+    out = []
+    for i in range(lines):
+        kind = rand.random()
+        if kind < 0.1:
+            out.append('\tat com.basho.riak.client.RiakClient.fetch(RiakClient.java:{})'.format(i))
+        elif kind < 0.15:
+            out.append('token=' + ''.join(rand.choice('ABCDEF0123456789') for j in range(400)))
+        else:
+            out.append('2013-02-{:02d} 10:{:02d}:{:02d}.{:03d} [error] <0.{}.0>@riak_kv_vnode:handle_command:{} '
+                       'Read repair of {{<<"bucket">>,<<"key{}">>}}, siblings: {}'.format(
+                       i % 28 + 1, i % 60, i % 60, i % 1000, i, i % 500, i, ', '.join(['x'] * (i % 7))))
+    return '\n'.join(out)
+
+def timed(func, html, width):
+    soup = BeautifulSoup(html, 'html.parser')
+    start = time.time()
+    func(soup.pre, width)
+    return (time.time() - start, soup.pre.get_text())
+
+def threaded(html, width, threads):
+    soups = [BeautifulSoup(html, 'html.parser') for i in range(threads)]
+    workers = [threading.Thread(target=wrap_pre, args=(soup.pre, width)) for soup in soups]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return [soup.pre.get_text() for soup in soups]
+
+def main(argv):
+    print('{:>8} {:>10} {:>6} {:>12} {:>14} {:>6} {:>8}'.format(
+          'lines', 'markup', 'width', 'wrap_pre (s)', 'textwrap (s)', 'same', 'threads'))
+    for lines in [1000, 10000, 100000]:
+        log = log_dump(lines).replace('<', '&lt;')
+        for markup, html in [('string', '<pre>{}</pre>'.format(log)),
+                             ('code', '<pre><code>{}</code></pre>'.format(log)),
+                             ('spans', '<pre>' + '\n'.join('<span class="l">{}</span>'.format(l)
+                                                           for l in log.split('\n')) + '</pre>')]:
+            width = 80
+            t_new, r_new = timed(wrap_pre, html, width)
+            same_threaded = all(r == r_new for r in threaded(html, width, 4))
+            if lines <= 10000:
+                t_old, r_old = timed(textwrap_pre, html, width)
+                t_old, same = '{:.3f}'.format(t_old), r_new == r_old
+            else:
+                # Quadratic, and takes minutes
+                t_old, same = 'skipped', '-'
+            print('{:>8} {:>10} {:>6} {:>12.3f} {:>14} {:>6} {:>8}'.format(
+                  lines, markup, width, t_new, t_old, str(same), str(same_threaded)))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
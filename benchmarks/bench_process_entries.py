@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Benchmark process_entries on synthetic entries trees of increasing size,
+against the earlier implementation that built the body and toc up with
+repeated string concatenation. The concatenation timings stop once they take
+more than a few seconds.
+
+Usage: python benchmarks/bench_process_entries.py [BODY_SIZE]
+"""
+from __future__ import unicode_literals
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from zdf2pdf.zdf2pdf import process_entries
+
+def concat_process_entries(entries, entry_ids=None, body='', toc=''):
+    if entry_ids is None:
+        entry_ids = []
+    for entry in entries:
+        entry_ids.append(entry['id'])
+        if entry.has_key('section'):
+            body += '<a name="{}"></a><h1>{}</h1>\n'.format(entry['id'], entry['section'])
+            body += entry['body'] + '\n'
+            toc += '<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['section'])
+            toc += '<ol>\n'
+            entry_ids, body, toc = concat_process_entries(entry['topics'], entry_ids, body, toc)
+            toc += '<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['section'])
+            toc += '</ol>\n'
+        else:
+            body += '<a name="{}"></a><h1>{}</h1>\n'.format(entry['id'], entry['title'])
+            body += entry['body'] + '\n'
+            toc += '<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['title'])
+    return (entry_ids, body, toc)
+
+def synthetic_entries(count, body_size, per_section=100):
+    """
+    Build an entries tree of count entries, grouped into sections of
+    per_section entries, each with a body of about body_size characters.
+    """
+    body = '<p>{}</p>'.format('lorem ipsum ' * (body_size // 12))
+    entries = []
+    for s in range(0, count, per_section):
+        topics = [{'id': i, 'title': 'Entry {}'.format(i), 'body': body}
+                  for i in range(s, min(s + per_section, count))]
+        entries.append({'section': 'Section {}'.format(s), 'id': 'section-{}'.format(s),
+                        'body': body, 'topics': topics})
+    return entries
+
+def timed(func, entries):
+    start = time.time()
+    entry_ids, body, toc = func(entries)
+    return (time.time() - start, (body, toc))
+
+def main(argv):
+    body_size = int(argv[1]) if len(argv) > 1 else 2000
+    print('{:>8} {:>12} {:>12} {:>8}'.format('entries', 'list (s)', 'concat (s)', 'same'))
+    t_concat = 0
+    for count in [625, 1250, 2500, 5000, 10000]:
+        entries = synthetic_entries(count, body_size)
+        t_list, r_list = timed(process_entries, entries)
+        if t_concat < 5:
+            t_concat, r_concat = timed(concat_process_entries, entries)
+            print('{:>8} {:>12.3f} {:>12.3f} {:>8}'.format(count, t_list, t_concat,
+                                                           r_list == r_concat))
+        else:
+            # Concatenation grows quadratically, don't wait on it any longer
+            print('{:>8} {:>12.3f} {:>12} {:>8}'.format(count, t_list, '-', '-'))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Benchmark how long each zdf2pdf command line path takes to start and run,
+and how many modules it loads: help, listing forums and entries from a stub
+Zendesk server that answers each request after a delay, making a small PDF
+from a JSON file, and starting the render service.
+
+Every run is a new process, as it is when zdf2pdf is used from a shell, and
+the median of several runs is shown. For listing forums, the time until the
+first category is printed is shown too.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--categories 20]
+                                          [--forums 5] [--latency 0.05]
+"""
+from __future__ import unicode_literals
+import os, sys, time, shutil, subprocess, tempfile, threading
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, ROOT)
+import simplejson as json
+from bench_pipeline import corpus
+
+# Runs zdf2pdf with the given arguments, and reports the modules loaded
+RUNNER = '''
+import sys, atexit
+sys.path.insert(0, {root!r})
+atexit.register(lambda: sys.stderr.write('\\nMODULES %d\\n' % len(sys.modules)))
+from zdf2pdf import main
+sys.exit(main(['zdf2pdf'] + sys.argv[1:]))
+'''.format(root=str(ROOT))
+
+def zendesk_server(categories, forums, latency):
+    """
+    Start a stub Zendesk server in a thread, with categories categories of
+    forums forums each, answering every request after latency seconds.
+    Returns the server and its URL.
+    """
+    import BaseHTTPServer, SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            parts = self.path.split('?')[0].split('/')[3:]
+            if parts == ['categories.json']:
+                data = {'categories': [{'id': c, 'name': 'Category {}'.format(c)}
+                                       for c in range(1, categories + 1)]}
+            elif len(parts) == 3 and parts[0] == 'categories':
+                c = int(parts[1])
+                data = {'forums': [{'id': c * 100 + f, 'name': 'Forum {}'.format(c * 100 + f)}
+                                   for f in range(forums)]}
+            elif len(parts) == 3 and parts[0] == 'forums':
+                f = int(parts[1])
+                data = {'topics': [{'id': f * 1000 + t, 'title': 'Topic {}'.format(f * 1000 + t),
+                                    'body': '<p>Body</p>'} for t in range(30)]}
+            else:
+                self.send_error(404)
+                return
+            data['next_page'] = None
+            body = json.dumps(data)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+def run(args, env, until=None):
+    """
+    Run zdf2pdf with args. Returns the seconds taken, the seconds until the
+    first line of output, and the number of modules loaded. If until is
+    given, the process is stopped once a line starting with it is printed.
+    """
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', RUNNER] + args, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    first = None
+    for line in iter(proc.stdout.readline, b''):
+        if first is None:
+            first = time.time() - start
+        if until and line.startswith(until):
+            proc.terminate()
+            break
+    err = proc.stderr.read()
+    proc.wait()
+    seconds = time.time() - start
+    modules = [l for l in err.splitlines() if l.startswith(b'MODULES ')]
+    if proc.returncode and not until:
+        raise RuntimeError('zdf2pdf {} failed:\n{}'.format(' '.join(args), err))
+    return (seconds, first, int(modules[-1].split()[1]) if modules else None)
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+def main(argv):
+    argp = argparse.ArgumentParser(description='Benchmark zdf2pdf start up.')
+    argp.add_argument('--runs', type=int, default=5,
+        help='Runs of each path, the median is shown (default: 5)')
+    argp.add_argument('--categories', type=int, default=20,
+        help='Categories in the stub Zendesk (default: 20)')
+    argp.add_argument('--forums', type=int, default=5,
+        help='Forums in each category (default: 5)')
+    argp.add_argument('--latency', type=float, default=0.05,
+        help='Seconds the stub Zendesk takes to answer (default: 0.05)')
+    args = argp.parse_args(argv[1:])
+
+    work_dir = tempfile.mkdtemp(prefix='zdf2pdf-bench-')
+    server, url = zendesk_server(args.categories, args.forums, args.latency)
+    # Keep any ~/.zdf2pdf.cfg, and the entry cache in the temp dir, out of it
+    env = dict(os.environ, HOME=work_dir, TMPDIR=work_dir)
+    zd = ['-u', url, '-m', 'bench@example.com', '-p', 'secret']
+
+    json_file = os.path.join(work_dir, 'entries.json')
+    with open(json_file, 'w') as outfile:
+        json.dump(corpus(sections=2, entries=3, body=3, images=1, entry_images=0,
+                         pre=1, links=1), outfile)
+
+    paths = [
+        ('help', ['-h'], None),
+        ('list help', ['list', '-h'], None),
+        ('list forums, 1 worker', ['list', '--api-workers', '1'] + zd, None),
+        ('list forums', ['list'] + zd, None),
+        ('-l forums', ['-l'] + zd, None),
+        ('list entries', ['list', '100'] + zd, None),
+        ('render --json-file', ['--json-file', json_file, '-w', os.path.join(work_dir, 'w'),
+                                '-o', os.path.join(work_dir, 'out.pdf')], None),
+        ('serve until ready', ['serve', '--port', '0', '-w', os.path.join(work_dir, 's')],
+         b'Serving'),
+    ]
+
+    try:
+        print('{} categories of {} forums, {:.0f}ms a request, median of {} runs'.format(
+              args.categories, args.forums, args.latency * 1000, args.runs))
+        print('{:<24} {:>10} {:>14} {:>8}'.format('path', 'total (s)', 'first line (s)', 'modules'))
+        for name, path_args, until in paths:
+            results = [run(path_args, env, until) for i in range(args.runs)]
+            total, first, modules = [median(r[i] for r in results) for i in range(3)]
+            print('{:<24} {:>10.3f} {:>14} {:>8}'.format(
+                  name, total, '{:.3f}'.format(first) if first is not None else '-',
+                  modules if modules is not None else '-'))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
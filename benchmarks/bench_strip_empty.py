@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Benchmark strip_empty_tags on pathologically nested editor HTML, against the
+earlier implementation that searched the whole soup again after every round
+of removals. The earlier implementation recursed once per level of nesting,
+so deep documents hit the recursion limit.
+
+Usage: python benchmarks/bench_strip_empty.py
+"""
+from __future__ import unicode_literals
+import os, re, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bs4 import BeautifulSoup
+from zdf2pdf.zdf2pdf import strip_empty_tags
+
+def recursive_strip_empty_tags(soup):
+    emptymatches = re.compile('^(&nbsp;|\s|\n|\r|\t)*$')
+    emptytags = soup.findAll(lambda tag: tag.find(True) is None and (tag.string is None or tag.string.strip()=="" or tag.string.strip()==emptymatches) and not tag.isSelfClosing and not (tag.name=='a' and tag.name) and tag.name[0:3] != 'pdf')
+    if emptytags and (len(emptytags) != 0):
+        for t in emptytags: t.extract()
+        recursive_strip_empty_tags(soup)
+    return soup
+
+def nested(depth, width):
+    """
+    width copies of an empty tag nested depth deep, each next to some text
+    and an image that have to stay.
+    """
+    empty = '<div><span>' * (depth // 2) + '&nbsp;' + '</span></div>' * (depth // 2)
+    return '<body>' + '<p>keep <img src="x.png"/></p>{}'.format(empty) * width + '</body>'
+
+def timed(func, html):
+    soup = BeautifulSoup(html, 'html.parser')
+    start = time.time()
+    try:
+        func(soup)
+    except RuntimeError:
+        # maximum recursion depth exceeded
+        return (None, None)
+    return (time.time() - start, soup.decode())
+
+def main(argv):
+    print('{:>6} {:>6} {:>14} {:>14} {:>6}'.format('depth', 'width', 'single (s)', 'recursive (s)', 'same'))
+    for depth, width in [(10, 100), (50, 100), (200, 20), (1000, 2)]:
+        html = nested(depth, width)
+        t_single, r_single = timed(strip_empty_tags, html)
+        t_recursive, r_recursive = timed(recursive_strip_empty_tags, html)
+        print('{:>6} {:>6} {:>14.3f} {:>14} {:>6}'.format(depth, width, t_single,
+              '{:.3f}'.format(t_recursive) if t_recursive is not None else 'recursion',
+              r_single == r_recursive if r_recursive is not None else '-'))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
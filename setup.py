@@ -25,7 +25,7 @@ setup(name="zdf2pdf",
         "beautifulsoup4",
         "httplib2",
         "simplejson",
-        "zendesk",
         "configparser",
+        "PyPDF2",
       ]
 )
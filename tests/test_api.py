@@ -0,0 +1,119 @@
+"""
+ZendeskAPI and HTTPSession against a stub Zendesk on a local port
+"""
+from __future__ import unicode_literals
+import BaseHTTPServer, json, socket, SocketServer, threading, unittest
+import urlparse
+
+from zdf2pdf.api import ZendeskAPI
+from zdf2pdf.session import HTTPError, HTTPSession
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '{}'.format(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(path.query)
+        server.requests.append((self.headers.get('Host'), path.path,
+                                self.headers.get('Authorization')))
+
+        if path.path == '/api/v2/forums/1/topics.json':
+            # Three pages of 5 topics
+            page = int(query.get('page', ['1'])[0])
+            topics = [{'id': (page - 1) * 5 + i, 'title': 'Topic'} for i in range(5)]
+            next_page = None
+            if page < 3:
+                next_page = 'http://{}/api/v2/forums/1/topics.json?page={}'.format(
+                            self.headers.get('Host'), page + 1)
+            self.send(200, {'topics': topics, 'next_page': next_page})
+        elif path.path == '/limited':
+            # Rate limited the first time
+            server.limited += 1
+            if server.limited == 1:
+                self.send(429, {}, {'Retry-After': '2'})
+            else:
+                self.send(200, {'ok': True})
+        else:
+            self.send(200, {'ok': True})
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class StubTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.limited = 0
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.delays = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def sleep(self, seconds):
+        self.delays.append(seconds)
+
+    def test_pages(self):
+        zd = ZendeskAPI(self.url, sleep=self.sleep)
+        self.assertEqual([t['id'] for t in zd.list_topics(1)], range(15))
+        self.assertEqual([path for host, path, auth in self.server.requests],
+                         ['/api/v2/forums/1/topics.json'] * 3)
+        self.assertEqual(self.delays, [])
+
+    def test_rate_limited(self):
+        session = HTTPSession(sleep=self.sleep)
+        response, content = session.request(self.url + '/limited')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.limited, 2)
+        # The next request waited for as long as it was asked to
+        self.assertEqual(len(self.delays), 1)
+        self.assertTrue(1 < self.delays[0] <= 2, self.delays)
+
+    def test_connection_failed(self):
+        session = HTTPSession(sleep=self.sleep, connect_retries=3, connect_delay=1)
+        url = 'http://127.0.0.1:{}/'.format(free_port())
+        with self.assertRaises(HTTPError) as caught:
+            session.request(url)
+        self.assertEqual(caught.exception.status, None)
+        self.assertEqual(self.delays, [1, 2, 3])
+        # The slot is given back every time
+        response, content = session.request(self.url + '/')
+        self.assertEqual(response.status, 200)
+
+    def test_auth_host(self):
+        port = self.server.server_address[1]
+        session = HTTPSession(self.url, 'me@example.com', 'secret', is_token=True,
+                              sleep=self.sleep)
+        session.request(self.url + '/image.png')
+        session.request('http://localhost:{}/image.png'.format(port))
+        auth = dict((host, header) for host, path, header in self.server.requests)
+        self.assertEqual(auth['127.0.0.1:{}'.format(port)],
+                         'Basic ' + 'me@example.com/token:secret'.encode('base64').strip())
+        self.assertEqual(auth['localhost:{}'.format(port)], None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Entries flow from their inputs into the document without being kept once used
+"""
+from __future__ import unicode_literals
+import importlib, json, os, shutil, tempfile, unittest, weakref
+
+from zdf2pdf.zdf2pdf import default_state, gather_entries, harvest, read_entries
+
+class Topic(dict):
+    # A dictionary that can be watched with a weak reference
+    pass
+
+class FakeZendesk(object):
+    def __init__(self, forums, topics):
+        self.forums = forums
+        self.topics = topics
+
+    def _topic(self, topic_id):
+        return Topic(id=topic_id, title='Topic {}'.format(topic_id), body='')
+
+    def list_category_forums(self, cat_id):
+        return iter([self.show_forum(forum_id) for forum_id in self.forums])
+
+    def show_category(self, cat_id):
+        return {'id': cat_id, 'name': 'Category', 'description': ''}
+
+    def show_forum(self, forum_id):
+        return {'id': forum_id, 'name': 'Forum {}'.format(forum_id), 'description': ''}
+
+    def list_topics(self, forum_id):
+        for i in range(self.topics):
+            yield self._topic(forum_id * 10000 + i)
+
+    def show_topics(self, topic_ids):
+        for topic_id in topic_ids:
+            yield self._topic(int(topic_id))
+
+def walk(entries, used=None):
+    # Count the entries, checking that those used before are gone. Topics
+    # still to come may be waiting to be used, but none that have been.
+    if used is None:
+        used = []
+    for entry in entries:
+        if entry.has_key('topics'):
+            walk(entry['topics'], used)
+        else:
+            kept = [ref for ref in used if ref() is not None]
+            assert not kept, '{} topics kept'.format(len(kept))
+            used.append(weakref.ref(entry))
+    return len(used)
+
+class HarvestTest(unittest.TestCase):
+    def opts(self, **opts):
+        state = default_state()
+        state.update(verbose=False, category_sections=False, forum_sections=False)
+        state.update(opts)
+        return state
+
+    def test_forums(self):
+        zd = FakeZendesk([1, 2], 1000)
+        self.assertEqual(walk(harvest(zd, [], [1, 2], self.opts())), 2000)
+
+    def test_sections(self):
+        zd = FakeZendesk([1, 2], 1000)
+        opts = self.opts(category_sections=True, forum_sections=True)
+        self.assertEqual(walk(harvest(zd, [7], [3], opts)), 3000)
+
+    def test_gather(self):
+        zd = FakeZendesk([1], 1000)
+        state = self.opts(forums='1', topics='5,6,7', topics_heading='More')
+        self.assertEqual(walk(gather_entries(zd, state)), 1003)
+
+class TopicJSON(object):
+    # json as read_entries uses it, with records that can be watched
+    @staticmethod
+    def loads(line):
+        return json.loads(line, object_hook=Topic)
+
+class NDJSONTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'entries.ndjson')
+        self.module = importlib.import_module('zdf2pdf.zdf2pdf')
+        self.json = self.module.json
+        self.module.json = TopicJSON
+
+    def tearDown(self):
+        self.module.json = self.json
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, records):
+        with open(self.path, 'w') as outfile:
+            for record in records:
+                outfile.write(json.dumps(record) + '\n')
+
+    def section(self, section_id, topics):
+        records = [{'section': 'Section', 'id': section_id, 'body': ''}]
+        records.extend({'id': section_id * 10000 + i, 'title': 'Topic', 'body': ''}
+                       for i in range(topics))
+        return records + [{'end_section': True}]
+
+    def test_section(self):
+        self.write(self.section(1, 2000))
+        self.assertEqual(walk(read_entries(self.path)), 2000)
+
+    def test_nested(self):
+        records = self.section(1, 10)
+        records[-1:-1] = self.section(2, 500)
+        self.write(records + self.section(3, 500))
+        self.assertEqual(walk(read_entries(self.path)), 1010)
+
+    def test_unused(self):
+        # Topics a section's reader doesn't get to are passed over
+        self.write(self.section(1, 100) + [{'id': 7, 'title': 'Last', 'body': ''}])
+        entries = read_entries(self.path)
+        section = next(entries)
+        self.assertEqual([next(section['topics'])['id'] for i in range(3)],
+                         [10000, 10001, 10002])
+        self.assertEqual([entry['id'] for entry in entries], [7])
+
+if __name__ == '__main__':
+    unittest.main()
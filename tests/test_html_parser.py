@@ -0,0 +1,92 @@
+"""
+entries.html is the same whichever HTML parser reads the document. Broken
+HTML in entries is repaired by each parser in its own way, so the entries
+here are well formed.
+"""
+from __future__ import unicode_literals
+import os, sys, shutil, tempfile, unittest
+
+from zdf2pdf.zdf2pdf import UsageError, default_state, check_state, zdf2pdf
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden', 'entries.html')
+
+ENTRIES = [
+    {'id': 1, 'section': 'Installing', 'body': '<p>Before you begin</p>', 'topics': [
+        {'id': 10, 'title': 'Linux', 'updated_at': '2013-01-02T00:00:00Z',
+         'body': '<p>Run <code>make</code>, then see <a href="/entries/11-mac">Mac</a>.</p>'
+                 '<ul><li>One</li><li>Two</li></ul><p>Caf\u00e9 &amp; cr\u00e8me&nbsp;br\u00fbl\u00e9e</p>'},
+        {'id': 11, 'title': 'Mac', 'updated_at': '2013-01-03T00:00:00Z',
+         'body': '<pre>tar xzf riak.tar.gz\ncd riak\n</pre><p><span></span></p>'
+                 '<table><tbody><tr><td>a</td><td>b<br>c</td></tr></tbody></table>'},
+    ]},
+    {'id': 12, 'title': 'Upgrading', 'updated_at': '2013-01-04T00:00:00Z',
+     'body': '<div><p>Stop <b>each <i>node</i></b> in turn</p></div><hr>'},
+]
+
+def render(parser, work_dir):
+    opts = default_state()
+    opts.update({
+        'work_dir': work_dir,
+        'output_file': os.path.join(work_dir, 'out.pdf'),
+        'attach_cache': os.path.join(work_dir, 'attach-cache'),
+        'html_parser': parser,
+        'title': 'Golden',
+        'author': 'Tester',
+        'toc': True,
+        'strip_empty': True,
+        'header': '<div id="header">Golden<pdf:pagenumber /></div>',
+        'footer': '<div id="footer">PAGENO <pdf:pagenumber/> OF <pdf:pagecount/> end</div>'
+                  '<pdf:nextpage/>',
+    })
+    zdf2pdf(ENTRIES, opts)
+    with open(os.path.join(work_dir, 'entries.html'), 'rb') as infile:
+        return infile.read()
+
+def installed(parser):
+    if parser == 'html.parser':
+        return True
+    try:
+        __import__(parser)
+        return True
+    except ImportError:
+        return False
+
+class HTMLParserTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='zdf2pdf-test-')
+        with open(GOLDEN, 'rb') as infile:
+            self.golden = infile.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def check(self, parser):
+        if not installed(parser):
+            self.skipTest('{} is not installed'.format(parser))
+        self.assertEqual(render(parser, os.path.join(self.work_dir, parser)), self.golden)
+
+    def test_html_parser(self):
+        self.check('html.parser')
+
+    def test_lxml(self):
+        self.check('lxml')
+
+    def test_html5lib(self):
+        self.check('html5lib')
+
+    def test_not_installed(self):
+        state = default_state()
+        state['html_parser'] = 'html5lib'
+        # Importing a module set to None in sys.modules fails
+        saved = sys.modules.get('html5lib')
+        sys.modules['html5lib'] = None
+        try:
+            self.assertRaises(UsageError, check_state, state)
+        finally:
+            if saved is None:
+                del sys.modules['html5lib']
+            else:
+                sys.modules['html5lib'] = saved
+
+if __name__ == '__main__':
+    unittest.main()
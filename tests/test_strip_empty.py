@@ -0,0 +1,63 @@
+"""
+strip_empty_tags removes tags left with nothing in them in one pass
+"""
+from __future__ import unicode_literals
+import sys, unittest
+
+from bs4 import BeautifulSoup
+from zdf2pdf.zdf2pdf import strip_empty_tags
+
+def stripped(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    strip_empty_tags(soup)
+    return '{}'.format(soup)
+
+class StripEmptyTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(stripped('<p></p><p>text</p><span></span>'), '<p>text</p>')
+
+    def test_whitespace(self):
+        self.assertEqual(stripped('<p> \n\t </p><p>&nbsp;</p><p> &nbsp; \xa0</p><p>x</p>'),
+                         '<p>x</p>')
+
+    def test_whitespace_around_text(self):
+        self.assertEqual(stripped('<p> &nbsp;x </p>'), '<p> \xa0x </p>')
+
+    def test_nested(self):
+        self.assertEqual(stripped('<div><p><span> </span></p><b></b>\n</div><p>keep</p>'),
+                         '<p>keep</p>')
+
+    def test_nested_kept(self):
+        html = '<div><p><span></span></p><p><i>x</i><b> </b></p></div>'
+        self.assertEqual(stripped(html), '<div><p><i>x</i></p></div>')
+
+    def test_anchors(self):
+        html = '<div><a name="x"></a></div><a href="#x"></a>'
+        self.assertEqual(stripped(html), html)
+
+    def test_pdf_tags(self):
+        html = ('<div id="footer"><pdf:pagenumber></pdf:pagenumber></div>'
+                '<pdf:nextpage></pdf:nextpage>')
+        self.assertEqual(stripped(html), html)
+
+    def test_void_tags(self):
+        html = '<p><br/></p><div><img src="a.png"/></div><hr/>'
+        self.assertEqual(stripped(html), html)
+
+    def test_comments(self):
+        html = '<p><!-- kept --></p>'
+        self.assertEqual(stripped(html), html)
+
+    def test_deep(self):
+        depth = sys.getrecursionlimit() + 500
+        self.assertEqual(stripped('<div>' * depth + ' ' + '</div>' * depth + '<p>x</p>'),
+                         '<p>x</p>')
+
+    def test_deep_kept(self):
+        depth = sys.getrecursionlimit() + 500
+        soup = BeautifulSoup('<div>' * depth + 'x' + '</div>' * depth, 'html.parser')
+        strip_empty_tags(soup)
+        self.assertEqual(len(soup.find_all('div')), depth)
+
+if __name__ == '__main__':
+    unittest.main()
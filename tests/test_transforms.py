@@ -0,0 +1,40 @@
+"""
+run_transforms gives every transform the tags it handles in one traversal
+"""
+from __future__ import unicode_literals
+import unittest
+
+from bs4 import BeautifulSoup
+from zdf2pdf.zdf2pdf import Transform, run_transforms
+
+class CountTags(Transform):
+    def __init__(self, *tags):
+        self.tags = tags
+
+    def handle(self, tag):
+        self.counts[tag.name] = self.counts.get(tag.name, 0) + 1
+
+class EveryTag(Transform):
+    tags = True
+
+    def start(self, soup, opts):
+        self.counts['tags'] = 0
+
+    def handle(self, tag):
+        self.counts['tags'] += 1
+
+class TransformsTest(unittest.TestCase):
+    def test_counts(self):
+        soup = BeautifulSoup('<p>a<b>b</b></p><p><i>c</i><b>d</b></p>', 'html.parser')
+        transforms = [CountTags('p'), CountTags('b', 'i'), EveryTag()]
+        times = run_transforms(soup, transforms, {})
+        self.assertEqual([name for name, seconds in times],
+                         ['CountTags', 'CountTags', 'EveryTag'])
+        # Each transform counts for itself
+        self.assertEqual(transforms[0].counts, {'p': 2})
+        self.assertEqual(transforms[1].counts, {'b': 2, 'i': 1})
+        self.assertEqual(transforms[2].counts, {'tags': 5})
+        self.assertEqual(Transform.counts, None)
+
+if __name__ == '__main__':
+    unittest.main()
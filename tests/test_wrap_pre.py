@@ -0,0 +1,131 @@
+"""
+wrap_pre_text and wrap_pre wrap <pre> text as textwrap.TextWrapper did when
+zdf2pdf patched it to break on whitespace and commas
+"""
+from __future__ import unicode_literals
+import random, re, textwrap, threading, unittest
+
+from bs4 import BeautifulSoup
+from zdf2pdf.zdf2pdf import wrap_pre, wrap_pre_text
+
+class PreWrapper(textwrap.TextWrapper):
+    wordsep_simple_re = re.compile(r'(\s+|\,)')
+
+def textwrap_pre(text, width):
+    """
+    The text wrapped as zdf2pdf wrapped <pre> blocks with textwrap.
+    """
+    w = PreWrapper(width=width, replace_whitespace=False, drop_whitespace=False,
+                   break_on_hyphens=False, break_long_words=True)
+    return ''.join('\n'.join(w.wrap(line)) + '\n' for line in text.splitlines())
+
+def wrapped(text, width):
+    return ''.join(piece for start, end, piece, same in wrap_pre_text(text, width))
+
+def log_dump(lines, seed=0):
+    rand = random.Random(seed)
+    out = []
+    for i in range(lines):
+        kind = rand.random()
+        if kind < 0.1:
+            out.append('\tat com.basho.riak.client.RiakClient.fetch(RiakClient.java:{})'.format(i))
+        elif kind < 0.15:
+            out.append('token=' + ''.join(rand.choice('ABCDEF0123456789') for j in range(400)))
+        else:
+            out.append('2013-02-{:02d} 10:{:02d} [error] <0.{}.0>@riak_kv_vnode:handle_command '
+                       'Read repair of {{<<"bucket">>,<<"key{}">>}}, siblings: {}'.format(
+                       i % 28 + 1, i % 60, i, i, ', '.join(['x'] * (i % 7))))
+    return '\r\n'.join(out)
+
+def wrap_html(html, width):
+    soup = BeautifulSoup(html, 'html.parser')
+    wrap_pre(soup.pre, width)
+    return soup
+
+class WrapPreTextTest(unittest.TestCase):
+    def check(self, text, widths=(1, 2, 3, 5, 8, 13, 40, 80)):
+        for width in widths:
+            self.assertEqual(wrapped(text, width), textwrap_pre(text, width),
+                             'width {} of {!r}'.format(width, text))
+
+    def test_short_lines(self):
+        self.check('one\ntwo three\n\nfour')
+
+    def test_commas(self):
+        self.check('a,b,c,d,e,f,g,h,i,j,k,l,m,n,o,p\nx, y, z,, ,w')
+
+    def test_tabs(self):
+        self.check('\tindented\tfields\there\n  \t mixed \t\t tabs\nab\tcd\tef\tgh')
+
+    def test_line_endings(self):
+        self.check('crlf\r\nlines\r\nhere and there\rcr only\r\r\nend')
+
+    def test_long_words(self):
+        self.check('short ' + 'x' * 50 + ' then ' + 'y,' * 30 + ' end\n' + 'z' * 200)
+
+    def test_whitespace(self):
+        self.check('   leading\ntrailing   \n      \n a  b   c    d     e')
+
+    def test_unicode(self):
+        self.check('caf\u00e9 cr\u00e8me br\u00fbl\u00e9e \u2014 \u65e5\u672c\u8a9e\u306e\u30c6\u30ad\u30b9\u30c8')
+
+    def test_random(self):
+        rand = random.Random(1)
+        for i in range(200):
+            text = ''.join(rand.choice('ab ,\t\n\r') for j in range(rand.randint(0, 60)))
+            self.check(text, widths=(1, 2, 4, 7, 10))
+
+    def test_log_dump(self):
+        text = log_dump(5000)
+        self.assertEqual(wrapped(text, 80), textwrap_pre(text, 80))
+
+    def test_one_huge_line(self):
+        text = ', '.join('field{}'.format(i) for i in range(50000))
+        self.assertEqual(wrapped(text, 80), textwrap_pre(text, 80))
+
+class WrapPreTest(unittest.TestCase):
+    def test_string(self):
+        soup = wrap_html('<pre>aaa bbb ccc ddd</pre>', 8)
+        self.assertEqual(soup.pre.string, textwrap_pre('aaa bbb ccc ddd', 8))
+
+    def test_nested(self):
+        html = ('<pre><code>aaa bbb <span class="k">ccc</span> ddd</code>'
+                '<b>eee,fff</b>ggg<br/>hhh iii</pre>')
+        soup = wrap_html(html, 8)
+        # The tags are all still there, around the same text
+        self.assertEqual(soup.pre.code.span.get_text(), 'ccc')
+        self.assertEqual(soup.pre.b.get_text().replace('\n', ''), 'eee,fff')
+        brs = soup.pre.find_all('br')
+        self.assertEqual(len(brs), 1)
+        # The <br> is the line ending
+        brs[0].replace_with('\n')
+        text = 'aaa bbb ccc dddeee,fffggg\nhhh iii'
+        self.assertEqual(soup.pre.get_text(), textwrap_pre(text, 8))
+
+    def test_comments(self):
+        soup = wrap_html('<pre>aaa <!-- not wrapped at all --> bbb ccc</pre>', 4)
+        self.assertEqual(soup.pre.contents[1], ' not wrapped at all ')
+
+    def test_empty(self):
+        soup = wrap_html('<pre></pre>', 8)
+        self.assertEqual(soup.pre.get_text(), '')
+
+    def test_threads(self):
+        html = '<pre><code>{}</code></pre>'.format(log_dump(300))
+        expected = wrap_html(html, 40).pre.get_text()
+        soups = [BeautifulSoup(html, 'html.parser') for i in range(8)]
+        threads = [threading.Thread(target=wrap_pre, args=(soup.pre, 40)) for soup in soups]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for soup in soups:
+            self.assertEqual(soup.pre.get_text(), expected)
+
+    def test_log_dump(self):
+        text = log_dump(5000)
+        soup = wrap_html('<pre>{}</pre>'.format(text.replace('<', '&lt;')), 80)
+        self.assertEqual(soup.pre.get_text(), textwrap_pre(text.replace('\r\n', '\n'), 80))
+
+if __name__ == '__main__':
+    unittest.main()
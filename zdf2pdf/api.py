@@ -0,0 +1,242 @@
+"""
+zdf2pdf.api: Minimal Zendesk API v2 client for retrieving forums and entries
+"""
+from __future__ import unicode_literals
+import os, hashlib, tempfile, threading, time
+import simplejson as json
+
+from .session import HTTPError, HTTPSession
+
+class ZendeskError(HTTPError):
+    """
+    A request to Zendesk failed. status is the HTTP status of the last
+    response, or None if no response was received.
+    """
+
+def write_json(path, data):
+    """
+    Write data as JSON to path atomically, so a reader never sees a partially
+    written file even while other threads or processes are writing it too.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(data, outfile)
+        os.chmod(tmppath, 0o644)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+class EntryCache(object):
+    """
+    On-disk cache of Zendesk topics, kept in a directory as one JSON file per
+    topic ID. Alongside the topics, the ETag, topic IDs, and next page of each
+    page of topics received are kept, so a later request for the same page can
+    be made conditional and answered from the cache when nothing has changed.
+
+    A topic's file is only rewritten when its updated_at has changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.topics_dir = os.path.join(path, 'topics')
+        self.pages_dir = os.path.join(path, 'pages')
+        for d in [self.topics_dir, self.pages_dir]:
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # Created by someone else in the meantime
+                    if not os.path.isdir(d):
+                        raise
+
+        self._lock = threading.Lock()
+        # Count of topics used from the cache and received new or changed
+        self.unchanged = 0
+        self.changed = 0
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return None
+
+    def _page_file(self, url):
+        return os.path.join(self.pages_dir,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _topic_file(self, topic_id):
+        return os.path.join(self.topics_dir, '{}.json'.format(topic_id))
+
+    def get_page(self, url):
+        """
+        Return the cached page for url as a dictionary with etag, ids, and
+        next_page, or None if the page is not cached.
+        """
+        return self._read(self._page_file(url))
+
+    def get_topics(self, ids):
+        """
+        Return the cached topics with the given IDs, or None if any of them
+        are not in the cache.
+        """
+        topics = []
+        for topic_id in ids:
+            topic = self._read(self._topic_file(topic_id))
+            if topic is None:
+                return None
+            topics.append(topic)
+        with self._lock:
+            self.unchanged += len(topics)
+        return topics
+
+    def put_page(self, url, etag, topics, next_page):
+        """
+        Store the topics received for url, and the page itself if it has an
+        ETag to revalidate it with.
+        """
+        changed = 0
+        for topic in topics:
+            topic_file = self._topic_file(topic['id'])
+            cached = self._read(topic_file)
+            if (cached is None or not topic.get('updated_at')
+                    or cached.get('updated_at') != topic.get('updated_at')):
+                write_json(topic_file, topic)
+                changed += 1
+        with self._lock:
+            self.changed += changed
+            self.unchanged += len(topics) - changed
+
+        if etag:
+            write_json(self._page_file(url), {'etag': etag,
+                                              'ids': [t['id'] for t in topics],
+                                              'next_page': next_page})
+
+class ZendeskAPI(object):
+    """
+    Retrieve categories, forums, and topics from Zendesk.
+
+    Listings follow every next_page link and are returned as generators, so
+    results can be used as each page arrives. Requests are made through an
+    HTTPSession, which retries rate limited requests after the delay Zendesk
+    asks for.
+
+    If an EntryCache is given, pages of topics are requested conditionally
+    and unchanged pages are read from the cache.
+
+    If a memo dictionary is given, every page and object received is kept in
+    it and not requested again. A memo may be shared by several ZendeskAPI
+    objects, such as those of several run sections, so that forums and
+    topics they have in common are only requested once.
+
+    One ZendeskAPI may be shared between threads, which share its pool of
+    connections, up to per_host at once.
+    """
+    def __init__(self, url, mail=None, password=None, is_token=False,
+                 cache=None, timeout=60, max_retries=8, max_backoff=300,
+                 sleep=time.sleep, memo=None, per_host=8):
+        self.url = url.rstrip('/')
+        self.cache = cache
+        self.memo = memo
+        self.session = HTTPSession(self.url, mail, password, is_token,
+                                   timeout=timeout, max_retries=max_retries,
+                                   max_backoff=max_backoff, per_host=per_host,
+                                   headers={'Accept': 'application/json'},
+                                   sleep=sleep)
+
+    def request(self, path, headers=None):
+        """
+        GET a path under the Zendesk /api/v2/ URL, or a full URL such as a
+        next_page link. Returns a tuple of the httplib2 response and the
+        decoded JSON, which is None for a 304 Not Modified response.
+        """
+        if path.startswith('http://') or path.startswith('https://'):
+            url = path
+        else:
+            url = '{}/api/v2/{}'.format(self.url, path.lstrip('/'))
+
+        try:
+            response, content = self.session.request(url, headers)
+        except HTTPError as e:
+            raise ZendeskError('{}'.format(e), e.status)
+
+        if response.status == 304:
+            return (response, None)
+        if response.status != 200:
+            raise ZendeskError('{} returned {}'.format(url, response.status), response.status)
+        return (response, json.loads(content))
+
+    def iter_pages(self, path, key):
+        """
+        Yield each item of the key list of the response for path and of
+        every page following it.
+        """
+        while path:
+            page = self.memo.get((self.url, path)) if self.memo is not None else None
+            if page:
+                items, next_page = page
+            elif self.cache and key == 'topics':
+                items, next_page = self._cached_topics_page(path)
+            else:
+                response, data = self.request(path)
+                items, next_page = data[key], data.get('next_page')
+            if self.memo is not None:
+                self.memo[(self.url, path)] = (items, next_page)
+            for item in items:
+                yield item
+            path = next_page
+
+    def _cached_topics_page(self, path):
+        page = self.cache.get_page(path)
+        if page:
+            response, data = self.request(path, {'If-None-Match': page['etag']})
+            if data is None:
+                # Not modified, use what was cached
+                topics = self.cache.get_topics(page['ids'])
+                if topics is not None:
+                    return (topics, page['next_page'])
+                # Part of the page has gone missing from the cache
+                response, data = self.request(path)
+        else:
+            response, data = self.request(path)
+
+        self.cache.put_page(path, response.get('etag'), data['topics'],
+                            data.get('next_page'))
+        return (data['topics'], data.get('next_page'))
+
+    def list_categories(self):
+        return self.iter_pages('categories.json', 'categories')
+
+    def list_category_forums(self, category_id):
+        return self.iter_pages('categories/{}/forums.json'.format(category_id), 'forums')
+
+    def list_topics(self, forum_id):
+        return self.iter_pages('forums/{}/topics.json'.format(forum_id), 'topics')
+
+    def show_topics(self, topic_ids):
+        """
+        Yield the topics with the given IDs, requested up to 100 at a time.
+        """
+        topic_ids = list(topic_ids)
+        for i in range(0, len(topic_ids), 100):
+            ids = ','.join('{}'.format(t) for t in topic_ids[i:i + 100])
+            for topic in self.iter_pages('topics/show_many.json?ids={}'.format(ids), 'topics'):
+                yield topic
+
+    def show(self, path, key):
+        """
+        Return the key object of the response for path.
+        """
+        if self.memo is not None and (self.url, path) in self.memo:
+            return self.memo[(self.url, path)]
+        item = self.request(path)[1][key]
+        if self.memo is not None:
+            self.memo[(self.url, path)] = item
+        return item
+
+    def show_category(self, category_id):
+        return self.show('categories/{}.json'.format(category_id), 'category')
+
+    def show_forum(self, forum_id):
+        return self.show('forums/{}.json'.format(forum_id), 'forum')
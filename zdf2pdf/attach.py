@@ -0,0 +1,198 @@
+"""
+zdf2pdf.attach: Content addressed cache of downloaded attachments and images
+"""
+from __future__ import unicode_literals
+import os, errno, hashlib, mimetypes, shutil, tempfile, threading, time
+import urlparse
+import simplejson as json
+
+from .api import write_json
+from .session import HTTPError, HTTPSession
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+class AttachmentCache(object):
+    """
+    A cache of downloaded attachments that can be shared between run sections
+    and working directories, and by several zdf2pdf processes at once.
+
+    Files are stored under objects/ named by the SHA-1 of their contents, so a
+    file found at several URLs is only stored once. index.json maps each URL
+    to the hash of its contents along with the ETag and Last-Modified headers
+    it was served with. A URL that is already cached is revalidated with a
+    conditional request the first time it is used by this cache object.
+
+    prune() evicts the least recently used files once the cache grows past
+    max_size bytes, and any file that has not been used for max_age seconds.
+
+    Files are downloaded through the HTTPSession session, or one without
+    credentials if none is given.
+    """
+    def __init__(self, path, max_size=None, max_age=None, session=None):
+        self.path = path
+        self.session = session or HTTPSession()
+        self.objects_dir = os.path.join(path, 'objects')
+        self.index_file = os.path.join(path, 'index.json')
+        self.max_size = max_size
+        self.max_age = max_age
+        makedirs(self.objects_dir)
+
+        self._lock = threading.Lock()
+        self.index = self._read_index()
+        # URLs revalidated or fetched by this cache object
+        self._fresh = set()
+        # URLs whose index entries have changed and need saving
+        self._dirty = set()
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, 'r') as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return {}
+
+    def object_file(self, name):
+        """
+        The path of a cached file given its name, the hash and extension.
+        """
+        return os.path.join(self.objects_dir, name[0:2], name)
+
+    def _extension(self, url, content_type):
+        ext = os.path.splitext(urlparse.urlparse(url).path)[1].lower()
+        if not ext or len(ext) > 5:
+            ext = mimetypes.guess_extension((content_type or '').split(';')[0].strip()) or ''
+        return ext
+
+    def _update(self, url, entry):
+        with self._lock:
+            entry['used'] = time.time()
+            self.index[url] = entry
+            self._fresh.add(url)
+            self._dirty.add(url)
+
+    def fetch(self, url):
+        """
+        Return the path of the cached file for url, downloading it if it is
+        not cached or has changed. Raises an exception if it can't be had.
+        """
+        with self._lock:
+            entry = self.index.get(url)
+            if entry and not os.path.isfile(self.object_file(entry['name'])):
+                # Evicted by someone else
+                entry = None
+
+        if entry and url in self._fresh:
+            self._update(url, dict(entry))
+            return self.object_file(entry['name'])
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response, content = self.session.request(url, headers)
+        if entry and response.status == 304:
+            # Not modified, the cached file is still good
+            self._update(url, dict(entry))
+            return self.object_file(entry['name'])
+        if response.status != 200:
+            raise HTTPError('HTTP Error {}'.format(response.status), response.status)
+
+        # Write to a temporary file and then move it into place under the hash
+        # of its contents. A failed write leaves nothing behind.
+        name = hashlib.sha1(content).hexdigest() + self._extension(url,
+                                                    response.get('content-type'))
+        objfile = self.object_file(name)
+        if not os.path.isfile(objfile):
+            makedirs(os.path.dirname(objfile))
+            fd, tmpfile = tempfile.mkstemp(dir=self.objects_dir, suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as outfile:
+                    outfile.write(content)
+                os.chmod(tmpfile, 0o644)
+                os.rename(tmpfile, objfile)
+            except:
+                if os.path.isfile(tmpfile):
+                    os.remove(tmpfile)
+                raise
+
+        self._update(url, {
+            'name': name,
+            'size': os.path.getsize(objfile),
+            'etag': response.get('etag'),
+            'last_modified': response.get('last-modified'),
+        })
+        return objfile
+
+    def save(self):
+        """
+        Write out the index, merged with any changes other processes have
+        saved since it was read.
+        """
+        with self._lock:
+            index = self._read_index()
+            for url in self._dirty:
+                if url in index and index[url].get('used', 0) > self.index[url]['used']:
+                    continue
+                index[url] = self.index[url]
+            write_json(self.index_file, index)
+            self.index = index
+            self._dirty = set()
+
+    def prune(self):
+        """
+        Evict files unused for longer than max_age, and then the least recently
+        used files until the cache is no bigger than max_size. Saves the index.
+        """
+        with self._lock:
+            index = self._read_index()
+            index.update((url, self.index[url]) for url in self._dirty)
+
+            # Each file is as recently used as the most recent of its URLs
+            used = {}
+            sizes = {}
+            for url, entry in index.iteritems():
+                used[entry['name']] = max(used.get(entry['name'], 0), entry.get('used', 0))
+                sizes[entry['name']] = entry.get('size', 0)
+
+            evict = set()
+            if self.max_age:
+                oldest = time.time() - self.max_age
+                evict.update(name for name, t in used.iteritems() if t < oldest)
+
+            if self.max_size:
+                total = sum(size for name, size in sizes.iteritems() if name not in evict)
+                for name in sorted(used, key=used.get):
+                    if total <= self.max_size:
+                        break
+                    if name not in evict:
+                        evict.add(name)
+                        total -= sizes[name]
+
+            for name in evict:
+                try:
+                    os.remove(self.object_file(name))
+                except OSError:
+                    pass
+
+            self.index = dict((url, entry) for url, entry in index.iteritems()
+                              if entry['name'] not in evict)
+            self._fresh -= set(url for url in self._fresh if url not in self.index)
+            self._dirty = set()
+            write_json(self.index_file, self.index)
+
+def link_or_copy(src, dst):
+    """
+    Hard link src to dst, or copy it if it can't be linked.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
@@ -0,0 +1,174 @@
+"""
+zdf2pdf.images: Shrink images before they are put in the PDF
+"""
+from __future__ import unicode_literals
+import os, hashlib, tempfile, time
+import simplejson as json
+
+from .attach import makedirs, link_or_copy
+
+def optimize_image(args):
+    """
+    Resize and recompress the image srcfile to dstfile. Runs in a worker
+    process. Returns a tuple of the original width and height, whether
+    dstfile was written, and an error message or None.
+
+    Images wider than max_width pixels are scaled down, images are made grey
+    if grayscale is set, and JPEGs are saved with the given quality. The
+    result is only kept if it is smaller than the original or had to be
+    changed. Animated images are left as they are, and other images are
+    saved in the format they came in.
+    """
+    from PIL import Image
+
+    srcfile, dstfile, max_width, quality, grayscale = args
+    try:
+        img = Image.open(srcfile)
+        size = img.size
+        fmt = img.format
+        if getattr(img, 'is_animated', False):
+            return (size, False, None)
+
+        changed = False
+        if max_width and img.size[0] > max_width:
+            height = max(1, int(round(img.size[1] * max_width / float(img.size[0]))))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            img = img.resize((max_width, height), Image.ANTIALIAS)
+            changed = True
+        if grayscale and img.mode not in ('L', 'LA'):
+            has_alpha = img.mode in ('RGBA', 'LA') or 'transparency' in img.info
+            img = img.convert('LA' if has_alpha else 'L')
+            changed = True
+
+        save = {}
+        if fmt == 'JPEG':
+            if img.mode not in ('L', 'RGB', 'CMYK'):
+                img = img.convert('RGB')
+            save = {'quality': quality or 85, 'optimize': True}
+        elif fmt == 'PNG':
+            save = {'optimize': True}
+        elif not changed:
+            return (size, False, None)
+
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(dstfile), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                img.save(outfile, fmt, **save)
+            if not changed and os.path.getsize(tmpfile) >= os.path.getsize(srcfile):
+                os.remove(tmpfile)
+                return (size, False, None)
+            os.chmod(tmpfile, 0o644)
+            os.rename(tmpfile, dstfile)
+        except:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            raise
+    except Exception as e:
+        return (None, False, '{}'.format(e))
+    return (size, True, None)
+
+class ImageOptimizer(object):
+    """
+    Shrinks downloaded images, keeping the results in a directory between
+    runs. Results are named by the name of the original, which is the hash of
+    its contents, and the settings, so each image is only shrunk once for
+    each set of settings.
+
+    Alongside each result is a .json file with the original size of the
+    image, so the image can be shown at the size it would have been. The
+    .json file is kept for images that could not be made smaller too, so
+    they aren't tried again.
+    """
+    def __init__(self, path, max_width=None, quality=None, grayscale=False,
+                 max_age=None):
+        self.path = path
+        self.max_width = max_width
+        self.quality = quality
+        self.grayscale = bool(grayscale)
+        self.max_age = max_age
+        makedirs(path)
+        # Count of images found optimized and optimized in this run
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name):
+        settings = json.dumps([self.max_width, self.quality, self.grayscale])
+        return hashlib.sha1(name.encode('utf-8') + settings.encode('utf-8')).hexdigest()
+
+    def _read(self, key):
+        try:
+            with open(os.path.join(self.path, key + '.json'), 'r') as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return None
+
+    def optimize(self, srcfiles, workers=None):
+        """
+        Shrink the image files srcfiles using a pool of worker processes.
+        Returns a dictionary mapping each file that was replaced to a tuple of
+        the file to use instead and the original width and height, and a list
+        of (srcfile, error) tuples for any that could not be read.
+        """
+        import multiprocessing
+        from .api import write_json
+
+        done = {}
+        todo = []
+        for srcfile in set(srcfiles):
+            name = os.path.basename(srcfile)
+            key = self.key(name)
+            info = self._read(key)
+            dstfile = os.path.join(self.path, key + os.path.splitext(name)[1])
+            if info is not None and (not info['optimized'] or os.path.isfile(dstfile)):
+                self.hits += 1
+                done[srcfile] = (info, dstfile)
+                for path in [dstfile, os.path.join(self.path, key + '.json')]:
+                    if os.path.isfile(path):
+                        os.utime(path, None)
+            else:
+                todo.append((srcfile, key, dstfile))
+
+        errors = []
+        if todo:
+            self.misses += len(todo)
+            pool = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(), len(todo)))
+            try:
+                results = pool.map(optimize_image,
+                                   [(src, dst, self.max_width, self.quality, self.grayscale)
+                                    for src, k, dst in todo])
+            finally:
+                pool.close()
+                pool.join()
+            for (srcfile, key, dstfile), (size, optimized, err) in zip(todo, results):
+                if err:
+                    errors.append((srcfile, err))
+                    continue
+                info = {'size': size, 'optimized': optimized}
+                write_json(os.path.join(self.path, key + '.json'), info)
+                done[srcfile] = (info, dstfile)
+
+        replaced = {}
+        for srcfile, (info, dstfile) in done.iteritems():
+            if info['optimized']:
+                # Put it next to the original in the attachments directory
+                newfile = os.path.splitext(srcfile)[0] + '-' + os.path.basename(dstfile)
+                if not os.path.isfile(newfile):
+                    link_or_copy(dstfile, newfile)
+                replaced[srcfile] = (newfile, tuple(info['size']))
+        return (replaced, errors)
+
+    def prune(self):
+        """
+        Remove results unused for longer than max_age seconds.
+        """
+        if not self.max_age:
+            return
+        oldest = time.time() - self.max_age
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,43 @@
+"""
+zdf2pdf.listing: List Zendesk forums and entries without loading what making
+PDFs needs
+"""
+from __future__ import unicode_literals
+
+def main(argv):
+    """
+    List the forums of every category, or the entries of a forum, given the
+    command line arguments after "list". Returns the exit status.
+    """
+    import argparse
+    from .zdf2pdf import (UsageError, zendesk_arguments, command_state, zendesk,
+                          check_state, list_forums, list_entries)
+
+    argp = argparse.ArgumentParser(prog='zdf2pdf list',
+        description='''List forums by ID and title organized by category, or
+        a forum's entries by ID and title.''')
+    argp.add_argument('forum', nargs='?', metavar='FORUM_ID',
+        help='Forum whose entries to list (default: list all forums)')
+    zendesk_arguments(argp)
+    state, args = command_state(argp, argv)
+    state['list_zdf'] = args.forum or 'forums'
+
+    try:
+        zd = zendesk(state)
+        check_state(state)
+        if args.forum:
+            try:
+                forum_id = int(args.forum)
+            except ValueError:
+                raise UsageError('Error: Could not convert to integer: {}'.format(args.forum))
+    except UsageError as e:
+        print(e)
+        return 1
+
+    if args.forum:
+        if state['verbose']: print('Listing all entries in forum {}'.format(forum_id))
+        list_entries(zd, forum_id)
+    else:
+        if state['verbose']: print('Listing all forums')
+        list_forums(zd, state['api_workers'])
+    return 0
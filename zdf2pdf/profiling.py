@@ -0,0 +1,85 @@
+"""
+zdf2pdf.profiling: Time, memory, and counts for each stage of making a PDF
+"""
+from __future__ import unicode_literals
+import os, sys, time, contextlib
+
+from .api import write_json
+
+def peak_rss():
+    """
+    The most memory this process has used so far, in bytes.
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, OS X gives bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class Profiler(object):
+    """
+    Records the wall time, peak memory, and counts such as entries or bytes
+    of each stage of a run, in the order the stages finish.
+
+    Peak memory is that of the whole process at the end of the stage, so a
+    stage that uses more memory than any before it shows an increase.
+
+    If cprofile_stage is given, the stage with that name is run under
+    cProfile, and the statistics are saved along with the report.
+    """
+    def __init__(self, cprofile_stage=None):
+        self.stages = []
+        self.cprofile_stage = cprofile_stage
+        self._cprofile = None
+        self.start = time.time()
+
+    def cprofile(self, name):
+        """
+        The cProfile.Profile to run the stage name under, or None if it
+        isn't being profiled.
+        """
+        if name != self.cprofile_stage:
+            return None
+        if self._cprofile is None:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+        return self._cprofile
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        """
+        Record the stage name for the duration of the with block. The
+        dictionary of counts is given to the block to add to.
+        """
+        prof = self.cprofile(name)
+        start = time.time()
+        if prof:
+            prof.enable()
+        try:
+            yield counts
+        finally:
+            if prof:
+                prof.disable()
+            self.add(name, time.time() - start, **counts)
+
+    def add(self, name, seconds, **counts):
+        """
+        Record a stage timed elsewhere.
+        """
+        self.stages.append({'name': name,
+                            'seconds': seconds,
+                            'peak_rss': peak_rss(),
+                            'counts': counts})
+
+    def report(self):
+        return {'stages': self.stages,
+                'seconds': time.time() - self.start,
+                'peak_rss': peak_rss()}
+
+    def write(self, path):
+        """
+        Write the report to profile.json in the directory path, and the
+        cProfile statistics to STAGE.prof if a stage was profiled.
+        """
+        write_json(os.path.join(path, 'profile.json'), self.report())
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(os.path.join(path, '{}.prof'.format(self.cprofile_stage)))
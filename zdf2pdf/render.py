@@ -0,0 +1,362 @@
+"""
+zdf2pdf.render: Render a document as separate chunks in worker processes and
+merge them into one PDF
+"""
+from __future__ import unicode_literals
+import os, hashlib, io, re, tempfile
+import simplejson as json
+
+from .api import write_json
+from .attach import makedirs
+
+# Comments placed in the document HTML to mark where it can be split. The
+# frames marker follows the header and footer, which every chunk needs, and
+# a chunk marker comes before each top level entry or section.
+FRAMES_MARKER = '<!--zdf2pdf:frames-->'
+CHUNK_MARKER = '<!--zdf2pdf:chunk-->'
+
+# Links between chunks can't be resolved while the chunks are rendered on
+# their own. Links to entries are given LINK_SCHEME URLs instead, and a
+# blank link with an ANCHOR_SCHEME URL is put in each entry heading. Both
+# end up as URI link annotations, which the merge turns into links to the
+# positions of the anchor annotations. These schemes only use letters as
+# xhtml2pdf ignores hrefs with other schemes.
+LINK_SCHEME = 'zdflink:'
+ANCHOR_SCHEME = 'zdfanchor:'
+
+# The positions given with each kind of outline destination
+FIT_ARGS = {'/XYZ': ['/Left', '/Top', '/Zoom'], '/FitH': ['/Top'], '/FitBH': ['/Top'],
+            '/FitV': ['/Left'], '/FitBV': ['/Left'],
+            '/FitR': ['/Left', '/Bottom', '/Right', '/Top']}
+
+NEXTPAGE = b'<pdf:nextpage />\n'
+PAGECOUNT_RE = re.compile(br'<pdf:pagecount\s*/?>(?:</pdf:pagecount>)?')
+
+def split_chunks(html):
+    """
+    Split the document HTML on the chunk markers. Returns a list of complete
+    documents, the first with everything before the first entry such as the
+    title page and table of contents, and then one for each top level entry
+    or section. Each has the head and the header and footer frames.
+    """
+    parts = html.split(CHUNK_MARKER.encode('utf-8'))
+    last = parts[-1]
+    tail = last[last.rindex(b'</body>'):]
+    parts[-1] = last[:last.rindex(b'</body>')]
+    marker = FRAMES_MARKER.encode('utf-8')
+    prefix = parts[0][:parts[0].index(marker) + len(marker)]
+
+    # Without a title page or table of contents there's nothing before the
+    # first entry to render
+    chunks = []
+    if parts[0][len(prefix):].strip():
+        chunks.append(parts[0] + tail)
+    for part in parts[1:]:
+        chunks.append(prefix + part + tail)
+    return chunks
+
+def _number_from(first):
+    # xhtml2pdf numbers pages with the reportlab canvas' page count, which
+    # can't otherwise be set. Only done in worker processes, which render
+    # one chunk at a time.
+    from xhtml2pdf.xhtml2pdf_reportlab import PmlBaseDoc
+
+    def beforeDocument(doc):
+        doc.canv._pageNumber = first
+    PmlBaseDoc.beforeDocument = beforeDocument
+
+def _restart_ids():
+    # xhtml2pdf names outline bookmarks from a counter kept for the life of
+    # the process, and a name can clash with an entry anchor. Starting it
+    # over for each chunk renders a chunk the same whichever worker renders
+    # it and whatever that worker rendered before.
+    import xhtml2pdf.util
+    xhtml2pdf.util._uid = 0
+
+def render_chunk(args):
+    """
+    Render a chunk to PDF with lead blank pages before it, numbering the
+    pages from first. Runs in a worker process. Returns a tuple of the PDF,
+    its page count, and the pisa error count, warning count, and log.
+    """
+    import xhtml2pdf.pisa as pisa
+    from PyPDF2 import PdfFileReader
+
+    html, lead, first = args
+    _number_from(first)
+    _restart_ids()
+    marker = FRAMES_MARKER.encode('utf-8')
+    start = html.index(marker) + len(marker)
+    html = html[:start] + NEXTPAGE * lead + html[start:]
+
+    out = io.BytesIO()
+    pdf = pisa.CreatePDF(io.BytesIO(html), out, encoding='utf-8')
+    pages = PdfFileReader(io.BytesIO(out.getvalue())).getNumPages()
+    return (out.getvalue(), pages, pdf.err, pdf.warn, pdf.log)
+
+class RenderCache(object):
+    """
+    Rendered chunks kept in a directory between runs, so that rebuilding a
+    document only renders the chunks that have changed.
+
+    Chunks are keyed by a hash of their HTML, salt such as the contents of
+    the stylesheet, and how they are rendered. The number of pages in each
+    chunk is kept too, so the page numbering of a document can be worked
+    out without rendering chunks that haven't changed. prune() removes
+    everything not used since the cache was opened.
+    """
+    def __init__(self, path, salt=b''):
+        self.path = path
+        self.salt = salt
+        makedirs(path)
+        self.used = set()
+        # Count of chunks found in the cache and rendered
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, html, **how):
+        sha1 = hashlib.sha1(self.salt)
+        sha1.update(html)
+        sha1.update(json.dumps(how, sort_keys=True))
+        return sha1.hexdigest()
+
+    def _write(self, name, data):
+        fd, tmppath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(data)
+            os.chmod(tmppath, 0o644)
+            os.rename(tmppath, os.path.join(self.path, name))
+        except:
+            os.remove(tmppath)
+            raise
+
+    def get_pages(self, key):
+        """
+        Return the number of pages in the chunk with the given key, or None
+        if it isn't known.
+        """
+        self.used.add(key + '.json')
+        try:
+            with open(os.path.join(self.path, key + '.json'), 'r') as infile:
+                return json.load(infile)['pages']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def put_pages(self, key, pages):
+        self.used.add(key + '.json')
+        write_json(os.path.join(self.path, key + '.json'), {'pages': pages})
+
+    def get(self, key):
+        """
+        Return the rendered chunk with the given key in the form returned by
+        render_chunk, or None if it isn't cached.
+        """
+        from PyPDF2 import PdfFileReader
+
+        self.used.add(key + '.pdf')
+        try:
+            with open(os.path.join(self.path, key + '.pdf'), 'rb') as infile:
+                pdf = infile.read()
+            pages = PdfFileReader(io.BytesIO(pdf)).getNumPages()
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (pdf, pages, 0, 0, [])
+
+    def put(self, key, result):
+        # Chunks with errors are rendered again next time
+        if not result[2]:
+            self.used.add(key + '.pdf')
+            self._write(key + '.pdf', result[0])
+
+    def prune(self):
+        for name in os.listdir(self.path):
+            if name not in self.used:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+def render_chunks(chunks, workers, cache=None):
+    """
+    Render the chunks in a pool of worker processes. Returns a list of
+    (result, lead) tuples, where result is the return value of render_chunk
+    and lead is the number of blank pages before the chunk's own pages.
+
+    Chunks are rendered with a blank page in front of all but the first, so
+    every chunk starts on the same page template as it would in the whole
+    document. Page counts are filled in once the number of pages in each
+    chunk is known, and pages are numbered on from the chunks before, which
+    may mean rendering some chunks again.
+
+    If a RenderCache is given, chunks are only rendered if they are not in
+    it, and are added to it once rendered.
+    """
+    import multiprocessing
+
+    lead = [0] + [1] * (len(chunks) - 1)
+    counted = any(PAGECOUNT_RE.search(html) for html in chunks)
+    numbered = counted or any(b'<pdf:pagenumber' in html for html in chunks)
+    if counted:
+        # Any count will do for laying out the pages
+        laid_out = [PAGECOUNT_RE.sub(b'000', html) for html in chunks]
+    else:
+        laid_out = chunks
+
+    results = [None] * len(chunks)
+    if cache:
+        layouts = [cache.key(html, lead=n) for html, n in zip(laid_out, lead)]
+        pages = [cache.get_pages(key) for key in layouts]
+    else:
+        pages = [None] * len(chunks)
+
+    pool = multiprocessing.Pool(min(workers, len(chunks)))
+    try:
+        # Lay out the chunks with unknown page counts, numbered from 1
+        todo = [i for i, count in enumerate(pages) if count is None]
+        for i, result in zip(todo, pool.map(render_chunk,
+                             [(laid_out[i], lead[i], 1) for i in todo])):
+            results[i] = result
+            pages[i] = result[1] - lead[i]
+            if cache:
+                cache.put_pages(layouts[i], pages[i])
+
+        first = [1] * len(chunks)
+        total = '{}'.format(sum(pages)).encode('utf-8')
+        if numbered:
+            number = 1
+            for i, count in enumerate(pages):
+                first[i] = number - lead[i]
+                number += count
+
+        # Render the chunks that weren't cached and weren't already rendered
+        # with the right page numbers
+        if cache:
+            keys = [cache.key(html, lead=n, first=f, total=total if counted else None)
+                    for html, n, f in zip(chunks, lead, first)]
+        redo = []
+        for i in range(len(chunks)):
+            cached = cache.get(keys[i]) if cache else None
+            if cached:
+                results[i] = cached
+            elif results[i] is None or first[i] != 1 or counted:
+                redo.append(i)
+            elif cache:
+                cache.put(keys[i], results[i])
+        redone = pool.map(render_chunk, [(PAGECOUNT_RE.sub(total, chunks[i]),
+                                          lead[i], first[i]) for i in redo])
+        for i, result in zip(redo, redone):
+            results[i] = result
+            if cache:
+                cache.put(keys[i], result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return zip(results, lead)
+
+def _copy_outline(writer, reader, outline, pages, parent=None):
+    # Add the bookmarks of a chunk's outline, nested as they are, pointing
+    # at the merged pages. Bookmarks of padding pages are left out, and any
+    # under them go under their parent instead.
+    from PyPDF2.generic import (ArrayObject, DictionaryObject, FloatObject,
+                                NameObject, NullObject, createStringObject)
+
+    # Named add_bookmark_dict in newer PyPDF2, which warns about the old name
+    add = getattr(writer, 'add_bookmark_dict', None) or writer.addBookmarkDict
+    kids = writer.getObject(writer._pages)['/Kids']
+    last = parent
+    for item in outline:
+        if isinstance(item, list):
+            _copy_outline(writer, reader, item, pages, last)
+            continue
+        page = pages.get(reader.getDestinationPageNumber(item))
+        if page is None:
+            last = parent
+            continue
+        dest = [kids[page], NameObject(item.typ)]
+        for k in FIT_ARGS.get(item.typ, []):
+            dest.append(NullObject() if item.get(k) is None else FloatObject(item.get(k)))
+        last = add(DictionaryObject({
+            NameObject('/Title'): createStringObject(item.title),
+            NameObject('/A'): DictionaryObject({NameObject('/S'): NameObject('/GoTo'),
+                                                NameObject('/D'): ArrayObject(dest)}),
+        }), parent)
+
+def merge_chunks(rendered, output):
+    """
+    Merge the rendered chunks into one PDF written to the file object output,
+    leaving out the blank padding pages. Links within a chunk are pointed at
+    the merged pages, and links to entries are pointed at their headings in
+    whichever chunk they are in. The outline of each chunk is added to the
+    outline of the merged PDF, in order.
+    """
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    from PyPDF2.generic import (ArrayObject, FloatObject, IndirectObject,
+                                NameObject, NullObject, NumberObject)
+
+    writer = PdfFileWriter()
+    kids = writer.getObject(writer._pages)['/Kids']
+
+    # Merged page references by the reader and object number of the chunk
+    # page they came from
+    refs = {}
+    added = []
+    outlines = []
+    for result, lead in rendered:
+        reader = PdfFileReader(io.BytesIO(result[0]))
+        # Merged page numbers by the chunk page they came from
+        pages = {}
+        for i in range(lead, reader.getNumPages()):
+            page = reader.getPage(i)
+            writer.addPage(page)
+            refs[(id(reader), page.indirectRef.idnum)] = kids[-1]
+            pages[i] = len(added)
+            added.append((reader, page))
+        outlines.append((reader, pages))
+
+    # Find the positions of the entry headings
+    anchors = {}
+    for n, (reader, page) in enumerate(added):
+        for annot_ref in page.get('/Annots', []):
+            uri = annot_ref.getObject().get('/A', {}).get('/URI', '')
+            if uri.startswith(ANCHOR_SCHEME):
+                anchors[uri[len(ANCHOR_SCHEME):]] = (kids[n], annot_ref.getObject()['/Rect'][3])
+
+    # Point links to entries at their headings and links within chunks at
+    # the merged pages. Anchors, links to padding pages, and links to entries
+    # not in the document are dropped.
+    for reader, page in added:
+        if '/Annots' not in page:
+            continue
+        annots = ArrayObject()
+        for annot_ref in page['/Annots']:
+            annot = annot_ref.getObject()
+            uri = annot.get('/A', {}).get('/URI', '')
+            if uri.startswith(ANCHOR_SCHEME):
+                continue
+            elif uri.startswith(LINK_SCHEME):
+                if uri[len(LINK_SCHEME):] not in anchors:
+                    continue
+                target, top = anchors[uri[len(LINK_SCHEME):]]
+                del annot['/A']
+                annot[NameObject('/Dest')] = ArrayObject([target, NameObject('/XYZ'),
+                                                          NullObject(), FloatObject(top),
+                                                          NumberObject(0)])
+            elif isinstance(annot.get('/Dest'), ArrayObject):
+                target = annot['/Dest'][0]
+                if isinstance(target, IndirectObject):
+                    target = refs.get((id(reader), target.idnum))
+                    if target is None:
+                        continue
+                    annot['/Dest'][0] = target
+            annots.append(annot_ref)
+        page[NameObject('/Annots')] = annots
+
+    for reader, pages in outlines:
+        _copy_outline(writer, reader, reader.getOutlines(), pages)
+
+    writer.write(output)
+    return len(added)
@@ -0,0 +1,107 @@
+"""
+zdf2pdf.selection: Choose which entries go into a PDF by their tags, dates,
+titles, and IDs
+"""
+from __future__ import unicode_literals
+import itertools, re, time
+
+# The options choosing entries
+OPTIONS = ['tags', 'updated_after', 'updated_before', 'title_match', 'exclude']
+
+def zendesk_time(value):
+    """
+    The date or time value, given as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ, in
+    the form of Zendesk's updated_at, so the two compare as strings. Raises
+    ValueError if it is neither.
+    """
+    for form in ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ']:
+        try:
+            return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.strptime(value.strip(), form))
+        except ValueError:
+            pass
+    raise ValueError('Could not read {} as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ'.format(value))
+
+class EntryFilter(object):
+    """
+    Keeps the entries that have any of tags, were updated at or after
+    updated_after and before updated_before, have a title matching the
+    regular expression title_match, and whose ID isn't in exclude. Filters
+    not given keep every entry. Sections are kept if any of the entries in
+    them are.
+
+    tags and exclude are comma separated strings, and the dates are as read
+    by zendesk_time. Raises ValueError if any can't be read.
+    """
+    def __init__(self, tags=None, updated_after=None, updated_before=None,
+                 title_match=None, exclude=None):
+        def split(value):
+            return set(v.strip().lower() for v in (value or '').split(',') if v.strip())
+
+        self.tags = split(tags)
+        self.exclude = split(exclude)
+        self.updated_after = zendesk_time(updated_after) if updated_after else None
+        self.updated_before = zendesk_time(updated_before) if updated_before else None
+        try:
+            self.title_match = re.compile(title_match, re.UNICODE) if title_match else None
+        except re.error as e:
+            raise ValueError('Could not compile title match {}: {}'.format(title_match, e))
+
+    def __nonzero__(self):
+        return bool(self.tags or self.exclude or self.updated_after or
+                    self.updated_before or self.title_match)
+
+    def keep(self, entry):
+        """
+        Whether to keep an entry, going by its ID, title, tags, and
+        updated_at alone.
+        """
+        if self.exclude and '{}'.format(entry['id']).lower() in self.exclude:
+            return False
+        if self.tags and not self.tags.intersection(t.lower() for t in entry.get('tags') or []):
+            return False
+        if self.updated_after or self.updated_before:
+            updated = entry.get('updated_at')
+            if not updated:
+                return False
+            if self.updated_after and updated < self.updated_after:
+                return False
+            if self.updated_before and updated >= self.updated_before:
+                return False
+        if self.title_match and not self.title_match.search(entry.get('title') or ''):
+            return False
+        return True
+
+    def tree(self, tree):
+        """
+        The list of sections and entries tree, as kept in an EntryStore,
+        with only those kept. Nothing but the metadata in the tree is read.
+        """
+        kept = []
+        for record in tree:
+            if record.has_key('section'):
+                topics = self.tree(record['topics'])
+                if topics:
+                    record = dict(record)
+                    record['topics'] = topics
+                    kept.append(record)
+            elif self.keep(record):
+                kept.append(record)
+        return kept
+
+    def entries(self, entries):
+        """
+        Yield the entries of entries that are kept, as they are received.
+        The topics of a section are an iterator over those kept, and the
+        section is only yielded once one of them has been.
+        """
+        for entry in entries:
+            if entry.has_key('section'):
+                topics = self.entries(entry['topics'])
+                first = next(topics, None)
+                if first is None:
+                    continue
+                entry = dict(entry)
+                entry['topics'] = itertools.chain([first], topics)
+                yield entry
+            elif self.keep(entry):
+                yield entry
@@ -0,0 +1,370 @@
+"""
+zdf2pdf.serve: A local HTTP service that makes PDFs in warm worker processes
+"""
+from __future__ import unicode_literals
+import os, shutil, threading, time, uuid
+import simplejson as json
+
+# The options a job may give. Everything else, such as paths, transforms, the
+# Zendesk URL, and the login, is the service's to decide.
+JOB_OPTIONS = ['categories', 'forums', 'topics', 'run_section', 'title',
+               'title_class', 'author', 'date', 'copyright', 'toc', 'toc_class',
+               'toc_title', 'pre_width', 'strip_empty', 'html_parser',
+               'reproducible', 'low_memory', 'image_max_width', 'image_quality',
+               'image_grayscale', 'header', 'footer', 'category_sections',
+               'forum_sections', 'topics_heading', 'tags', 'updated_after',
+               'updated_before', 'title_match', 'exclude']
+
+class ServiceError(Exception):
+    """
+    A request to the service can't be done. status is the HTTP status to
+    answer with.
+    """
+    def __init__(self, msg, status=400):
+        Exception.__init__(self, msg)
+        self.status = status
+
+def warm():
+    """
+    Import everything making a PDF needs, so the first job doesn't wait for
+    it.
+    """
+    import bs4, PyPDF2
+    import xhtml2pdf.pisa
+    from . import api, attach, render, zdf2pdf
+    try:
+        import lxml.etree
+    except ImportError:
+        pass
+
+def _job_state(state, work_dir):
+    # Put the job's files in its own directory whatever its options say
+    state['work_dir'] = work_dir
+    state['output_file'] = os.path.join(work_dir, 'output.pdf')
+    state['delete'] = False
+    state['list_zdf'] = None
+
+def worker(jobs, events, config_file=None):
+    """
+    Make the PDF of each (job ID, state) tuple from the jobs queue until None
+    is received. Runs in a worker process. Progress is reported on the
+    events queue as (job ID, status, error, counts) tuples.
+    """
+    import signal, traceback
+    from .zdf2pdf import (UsageError, section_state, snapshot_state, zendesk,
+                          check_state, gather_entries, profiler, build)
+    # Interrupting the service stops the workers once their jobs are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, state = job
+        events.put((job_id, 'running', None, None))
+        work_dir = state['work_dir']
+        try:
+            if state['run_section']:
+                section_state(state, state['run_section'], config_file)
+            if state['from_snapshot']:
+                snapshot_state(state)
+            _job_state(state, work_dir)
+            zd = zendesk(state)
+            check_state(state)
+            prof = profiler(state)
+            with prof.stage('fetch'):
+                entries = gather_entries(zd, state)
+            build(entries, zd, state, prof)
+            counts = {'seconds': time.time() - prof.start}
+            for stage in prof.stages:
+                if stage['name'] == 'render':
+                    counts.update(stage['counts'])
+            events.put((job_id, 'done', None, counts))
+        except UsageError as e:
+            events.put((job_id, 'failed', '{}'.format(e), None))
+        except Exception as e:
+            traceback.print_exc()
+            events.put((job_id, 'failed', 'Error: {}'.format(e), None))
+
+class RenderService(object):
+    """
+    Jobs to make PDFs, queued for a pool of worker processes that are
+    started once and kept, with everything they need already imported.
+
+    Each job is made with the options of base_state updated with its own, in
+    a working directory of its own under work_dir. At most max_queued jobs
+    may be waiting or running at once.
+    """
+    def __init__(self, base_state, work_dir, workers=2, max_queued=16, config_file=None):
+        import multiprocessing
+
+        self.base_state = base_state
+        self.work_dir = os.path.abspath(work_dir)
+        self.max_queued = max_queued
+        self.jobs = {}
+        self._cond = threading.Condition()
+        self._queue = multiprocessing.Queue()
+        self._events = multiprocessing.Queue()
+        self._workers = [multiprocessing.Process(target=worker,
+                                                 args=(self._queue, self._events, config_file))
+                         for i in range(workers)]
+
+    def start(self):
+        for proc in self._workers:
+            proc.start()
+        events = threading.Thread(target=self._watch)
+        events.daemon = True
+        events.start()
+
+    def stop(self):
+        for proc in self._workers:
+            self._queue.put(None)
+        for proc in self._workers:
+            proc.join(10)
+            if proc.is_alive():
+                proc.terminate()
+
+    def _watch(self):
+        # Record the progress reported by the workers
+        while True:
+            job_id, status, error, counts = self._events.get()
+            with self._cond:
+                job = self.jobs[job_id]
+                job['status'] = status
+                job[{'running': 'started'}.get(status, 'finished')] = time.time()
+                if error:
+                    job['error'] = error
+                if counts:
+                    job['counts'] = counts
+                self._cond.notify_all()
+
+    def submit(self, options, entries=None):
+        """
+        Queue a job with the given options, which are those of main() named
+        in JOB_OPTIONS. If entries is given it is used as the JSON entries
+        file. Returns the job. Raises ServiceError if the job can't be
+        queued or gives other options.
+        """
+        import copy
+
+        refused = [k for k in options if k not in JOB_OPTIONS]
+        if refused:
+            raise ServiceError('Options not allowed: {}'.format(', '.join(sorted(refused))))
+
+        with self._cond:
+            waiting = sum(1 for job in self.jobs.itervalues()
+                          if job['status'] in ('queued', 'running'))
+            if waiting >= self.max_queued:
+                raise ServiceError('Too many jobs, try again later', 503)
+
+            job_id = uuid.uuid4().hex
+            job = {'id': job_id, 'status': 'queued', 'created': time.time()}
+            self.jobs[job_id] = job
+
+        job_dir = os.path.join(self.work_dir, 'jobs', job_id)
+        os.makedirs(job_dir)
+        state = copy.deepcopy(self.base_state)
+        state.update(options)
+        if entries is not None:
+            state['json_file'] = os.path.join(job_dir, 'request.json')
+            with open(state['json_file'], 'w') as outfile:
+                json.dump(entries, outfile)
+        _job_state(state, job_dir)
+        self._queue.put((job_id, state))
+        return dict(job)
+
+    def status(self, job_id):
+        with self._cond:
+            if job_id not in self.jobs:
+                raise ServiceError('No job {}'.format(job_id), 404)
+            return dict(self.jobs[job_id])
+
+    def wait(self, job_id, timeout):
+        """
+        Wait up to timeout seconds for a job to finish. Returns its status.
+        """
+        end = time.time() + timeout
+        with self._cond:
+            while self.status(job_id)['status'] in ('queued', 'running'):
+                if time.time() >= end:
+                    break
+                self._cond.wait(end - time.time())
+            return self.status(job_id)
+
+    def output_file(self, job_id):
+        return os.path.join(self.work_dir, 'jobs', job_id, 'output.pdf')
+
+    def delete(self, job_id):
+        with self._cond:
+            if self.status(job_id)['status'] in ('queued', 'running'):
+                raise ServiceError('Job {} has not finished'.format(job_id), 409)
+            del self.jobs[job_id]
+        shutil.rmtree(os.path.join(self.work_dir, 'jobs', job_id), ignore_errors=True)
+
+def make_server(service, host='127.0.0.1', port=8080, verbose=False):
+    """
+    An HTTP server for the RenderService service. Each request is handled in
+    a thread of its own.
+
+        POST /jobs               queue a job given as {"options": {...},
+                                 "entries": [...]}, entries being optional
+        GET /jobs                the status of every job
+        GET /jobs/ID             the status of a job
+        GET /jobs/ID/pdf?wait=S  the PDF of a job, waiting up to S seconds
+                                 for it to finish
+        DELETE /jobs/ID          forget a finished job and remove its files
+    """
+    import BaseHTTPServer, SocketServer, urlparse
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            if verbose:
+                BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+        def _send_json(self, status, data, headers=None):
+            body = json.dumps(data)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).iteritems():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self):
+            url = urlparse.urlsplit(self.path)
+            parts = [p for p in url.path.split('/') if p]
+            if not parts or parts[0] != 'jobs' or len(parts) > 3:
+                raise ServiceError('Not found', 404)
+            return parts[1:], urlparse.parse_qs(url.query)
+
+        def _handle(self, method):
+            try:
+                method()
+            except ServiceError as e:
+                headers = {'Retry-After': '5'} if e.status == 503 else None
+                self._send_json(e.status, {'error': '{}'.format(e)}, headers)
+
+        def do_POST(self):
+            self._handle(self._post)
+
+        def do_GET(self):
+            self._handle(self._get)
+
+        def do_DELETE(self):
+            self._handle(self._delete)
+
+        def _post(self):
+            parts, query = self._route()
+            if parts:
+                raise ServiceError('Not found', 404)
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+                options = request.get('options', {})
+                if not isinstance(options, dict):
+                    raise ValueError('options must be an object')
+            except (ValueError, AttributeError) as e:
+                raise ServiceError('Bad request: {}'.format(e))
+            job = service.submit(options, request.get('entries'))
+            self._send_json(202, job, {'Location': '/jobs/{}'.format(job['id'])})
+
+        def _get(self):
+            parts, query = self._route()
+            if not parts:
+                with service._cond:
+                    jobs = [dict(job) for job in service.jobs.itervalues()]
+                self._send_json(200, sorted(jobs, key=lambda job: job['created']))
+            elif len(parts) == 1:
+                self._send_json(200, service.status(parts[0]))
+            elif parts[1] == 'pdf':
+                try:
+                    wait = float(query.get('wait', ['0'])[0])
+                except ValueError:
+                    raise ServiceError('Bad wait {}'.format(query['wait'][0]))
+                job = service.wait(parts[0], wait)
+                if job['status'] == 'failed':
+                    raise ServiceError(job.get('error', 'Failed'), 500)
+                if job['status'] != 'done':
+                    raise ServiceError('Job {} is {}'.format(job['id'], job['status']), 409)
+                with open(service.output_file(parts[0]), 'rb') as infile:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/pdf')
+                    self.send_header('Content-Length',
+                                     str(os.fstat(infile.fileno()).st_size))
+                    self.end_headers()
+                    shutil.copyfileobj(infile, self.wfile)
+            else:
+                raise ServiceError('Not found', 404)
+
+        def _delete(self):
+            parts, query = self._route()
+            if len(parts) != 1:
+                raise ServiceError('Not found', 404)
+            service.delete(parts[0])
+            self._send_json(200, {'id': parts[0], 'status': 'deleted'})
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    return Server((host, port), Handler)
+
+def main(argv):
+    """
+    Run the render service until interrupted, given the command line
+    arguments after "serve".
+    """
+    import argparse, signal, sys, tempfile
+    import configparser
+    from .zdf2pdf import default_state, config_state
+
+    argp = argparse.ArgumentParser(prog='zdf2pdf serve',
+        description='Make PDFs for jobs sent over HTTP.')
+    argp.add_argument('-v', '--verbose', action='store_true',
+        help='Verbose output')
+    argp.add_argument('--host', default='127.0.0.1',
+        help='Address to listen on (default: 127.0.0.1)')
+    argp.add_argument('--port', type=int, default=8080,
+        help='Port to listen on (default: 8080)')
+    argp.add_argument('--workers', type=int, default=2,
+        help='Number of jobs to make at once (default: 2)')
+    argp.add_argument('--queue', type=int, default=16,
+        help='Number of jobs that may be waiting or running (default: 16)')
+    argp.add_argument('-c', dest='config_file',
+        help='''Configuration file whose [zdf2pdf] section gives the options
+        of every job, and whose run sections jobs may use''')
+    argp.add_argument('-w', dest='work_dir',
+        default=os.path.join(tempfile.gettempdir(), 'zdf2pdf-serve'),
+        help='Directory in which to keep the files of each job (default: temp dir)')
+    args = argp.parse_args(argv)
+
+    # Options precedence for jobs:
+    # program state defaults, which are overridden by
+    # ~/.zdf2pdf.cfg [zdf2pdf] section options, which are overridden by
+    # -c CONFIG_FILE [zdf2pdf] section options, which are overridden by
+    # the job's options
+    state = default_state()
+    for path in [os.path.expanduser('~') + '/.zdf2pdf.cfg', args.config_file]:
+        if path:
+            try:
+                config_state(path, 'zdf2pdf', state)
+            except configparser.NoSectionError:
+                pass
+    state['verbose'] = args.verbose
+
+    service = RenderService(state, args.work_dir, args.workers, args.queue, args.config_file)
+    server = make_server(service, args.host, args.port, args.verbose)
+    service.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Serving on http://{}:{}/jobs with {} workers'.format(
+          args.host, server.server_address[1], args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
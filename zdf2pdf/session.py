@@ -0,0 +1,160 @@
+"""
+zdf2pdf.session: Pooled keep-alive HTTP connections shared by the Zendesk API
+client and the image downloader
+"""
+from __future__ import unicode_literals
+import base64, threading, time
+import urlparse
+
+class HTTPError(Exception):
+    """
+    A request failed. status is the HTTP status of the last response, or None
+    if no response was received.
+    """
+    def __init__(self, msg, status=None):
+        Exception.__init__(self, msg)
+        self.status = status
+
+class HTTPSession(object):
+    """
+    Make HTTP requests over persistent connections, pooled by host and
+    shared between threads. At most per_host requests are made to a host at
+    once, and a connection is kept open to be used by the next request to
+    the same host.
+
+    Requests that get 429 (rate limited) or 503 responses are retried after
+    the Retry-After delay given, or an exponentially increasing delay if none
+    was given. While one request is backing off, all other requests made
+    through the same session wait too.
+
+    Requests that fail to connect, or fail in any other way before a response
+    is received, are retried up to connect_retries times, waiting
+    connect_delay seconds more each time. Only that request waits, so a host
+    that can't be reached doesn't hold up requests to any other.
+
+    If mail and password are given, requests to auth_url's host are made with
+    them, and requests to any other host without. is_token says the password
+    is a Zendesk API token.
+    """
+    def __init__(self, auth_url=None, mail=None, password=None, is_token=False,
+                 timeout=60, max_retries=8, max_backoff=300, per_host=4,
+                 headers=None, sleep=time.sleep, connect_retries=2,
+                 connect_delay=1):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.connect_retries = connect_retries
+        self.connect_delay = connect_delay
+        self.max_backoff = max_backoff
+        self.per_host = per_host
+        self.sleep = sleep
+        self.headers = dict(headers or {})
+
+        self.auth_host = None
+        self.auth_header = None
+        if auth_url and mail and password:
+            self.auth_host = self._host(auth_url)
+            if is_token:
+                mail = mail + '/token'
+            credentials = '{}:{}'.format(mail, password).encode('utf-8')
+            self.auth_header = b'Basic ' + base64.b64encode(credentials)
+
+        self._lock = threading.Lock()
+        # Idle connections and a semaphore limiting requests, by host
+        self._idle = {}
+        self._slots = {}
+        # Adaptive backoff state shared between threads
+        self._backoff = 0
+        self._resume_at = 0
+
+    def _host(self, url):
+        parts = urlparse.urlsplit(url)
+        return (parts.scheme.lower(), parts.netloc.lower())
+
+    def _acquire(self, host):
+        import httplib2
+
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.per_host)
+                self._idle[host] = []
+        self._slots[host].acquire()
+        with self._lock:
+            if self._idle[host]:
+                return self._idle[host].pop()
+        return httplib2.Http(timeout=self.timeout)
+
+    def _release(self, host, http):
+        # A connection that failed is dropped rather than reused
+        if http is not None:
+            with self._lock:
+                self._idle[host].append(http)
+        self._slots[host].release()
+
+    def _wait(self):
+        # Hold off while any request is backing off
+        delay = self._resume_at - time.time()
+        if delay > 0:
+            self.sleep(delay)
+
+    def _throttled(self, retry_after):
+        with self._lock:
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = min(max(self._backoff * 2, 1), self.max_backoff)
+            self._backoff = delay
+            self._resume_at = max(self._resume_at, time.time() + delay)
+
+    def _recovered(self):
+        if self._backoff:
+            with self._lock:
+                self._backoff /= 2.0
+                if self._backoff < 1:
+                    self._backoff = 0
+
+    def request(self, url, headers=None, method='GET'):
+        """
+        Make a request, retrying as needed. Returns a tuple of the httplib2
+        response and its content. Responses other than 429 and 503 are
+        returned whatever their status. Raises HTTPError if every retry
+        failed.
+        """
+        host = self._host(url)
+        request_headers = dict(self.headers)
+        if self.auth_header and host == self.auth_host:
+            request_headers['Authorization'] = self.auth_header
+        if headers:
+            request_headers.update(headers)
+
+        status = None
+        failures = 0
+        for retry in range(self.max_retries + 1):
+            self._wait()
+            http = self._acquire(host)
+            response = None
+            try:
+                response, content = http.request(url, method, headers=request_headers)
+            except Exception as e:
+                error = e
+            finally:
+                # The slot is always given back, and a connection that failed
+                # is dropped rather than reused
+                self._release(host, http if response is not None else None)
+
+            if response is None:
+                # Connection trouble, wait a little and try again
+                failures += 1
+                if failures > self.connect_retries:
+                    raise HTTPError('{} failed: {}'.format(url, error))
+                self.sleep(self.connect_delay * failures)
+                continue
+
+            status = response.status
+            if status in (429, 503):
+                self._throttled(response.get('retry-after'))
+                continue
+
+            self._recovered()
+            return (response, content)
+
+        raise HTTPError('{} failed after {} retries'.format(url, self.max_retries), status)
@@ -0,0 +1,119 @@
+"""
+zdf2pdf.snapshot: Record what went into a PDF so it can be made again offline
+"""
+from __future__ import unicode_literals
+import os, contextlib, hashlib
+import simplejson as json
+
+from .api import write_json
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+# Options that only change how a document is made or where it is written, not
+# what is in it. These are taken from the command line rather than the
+# snapshot.
+RUN_OPTIONS = ['verbose', 'json_file', 'style_file', 'fetch_workers',
+               'api_workers', 'batch_workers', 'profile', 'profile_stage',
+               'attach_cache', 'attach_cache_size', 'attach_cache_age',
+               'low_memory', 'output_file', 'render_workers', 'incremental']
+
+class SnapshotError(Exception):
+    pass
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        while True:
+            chunk = infile.read(65536)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def write_manifest(work_dir, options, attachments, output_file):
+    """
+    Write the manifest of the snapshot in work_dir: the entries file, the
+    stylesheet, the options the document was made with, each image URL with
+    the file it was fetched to, and the PDF made. Every file is listed by
+    its path in work_dir with its SHA-1 hash.
+    """
+    files = {}
+    def listed(path):
+        name = os.path.relpath(path, work_dir).replace(os.sep, '/')
+        files[name] = file_sha1(path)
+        return name
+
+    manifest = {
+        'version': VERSION,
+        'entries': listed(os.path.join(work_dir, options['json_file'])),
+        'style_file': (listed(os.path.join(work_dir, options['style_file']))
+                       if options.get('style_file') else None),
+        'options': options,
+        'attachments': dict((url, listed(path)) for url, path in attachments.iteritems()),
+        'files': files,
+        'output': {'name': os.path.basename(output_file), 'sha1': file_sha1(output_file)},
+    }
+    write_json(os.path.join(work_dir, MANIFEST), manifest)
+    return manifest
+
+def read_manifest(path, verify=True):
+    """
+    Read the manifest of the snapshot in the directory path, and if verify
+    is set check the files in it. Raises SnapshotError if it is missing, or
+    any file in it is missing or has changed.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as infile:
+            manifest = json.load(infile)
+    except (IOError, ValueError) as e:
+        raise SnapshotError('Error: Could not read snapshot manifest in {}: {}'.format(path, e))
+    if manifest.get('version') != VERSION:
+        raise SnapshotError('Error: Unknown snapshot version {}'.format(manifest.get('version')))
+
+    if not verify:
+        return manifest
+    for name, sha1 in manifest['files'].iteritems():
+        try:
+            if file_sha1(os.path.join(path, *name.split('/'))) != sha1:
+                raise SnapshotError('Error: {} has changed since the snapshot was made'.format(name))
+        except IOError:
+            raise SnapshotError('Error: {} is missing from the snapshot'.format(name))
+    return manifest
+
+class SnapshotAttachments(object):
+    """
+    Stands in for an AttachmentCache, giving the images saved in a snapshot
+    instead of downloading them. URLs that aren't in the snapshot fail.
+    """
+    def __init__(self, path, manifest):
+        self.path = path
+        self.attachments = manifest['attachments']
+
+    def fetch(self, url):
+        try:
+            return os.path.join(self.path, *self.attachments[url].split('/'))
+        except KeyError:
+            raise SnapshotError('not in the snapshot')
+
+    def save(self):
+        pass
+
+    def prune(self):
+        pass
+
+@contextlib.contextmanager
+def reproducible(on=True):
+    """
+    Leave the creation date and a random document ID out of PDFs made in the
+    with block, so the same input makes the same bytes.
+    """
+    from reportlab import rl_config
+
+    invariant = rl_config.invariant
+    if on:
+        rl_config.invariant = 1
+    try:
+        yield
+    finally:
+        rl_config.invariant = invariant
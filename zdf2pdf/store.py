@@ -0,0 +1,196 @@
+"""
+zdf2pdf.store: Entries fetched from Zendesk once, kept on disk to make any
+number of PDFs from
+"""
+from __future__ import unicode_literals
+import os, tempfile, time
+import simplejson as json
+
+from .api import write_json
+
+TREE = 'tree.json'
+BODIES = 'bodies.dat'
+VERSION = 1
+
+class StoreError(Exception):
+    pass
+
+class EntryStore(object):
+    """
+    Entries kept in a directory as two files: tree.json, the sections and
+    entries in order and nested as given, with everything but their bodies,
+    and bodies.dat, every body one after another as UTF-8. The body of each
+    section and entry in the tree is its [offset, length] in bodies.dat.
+
+    The tree is small next to the bodies, so it is read whole and can be
+    looked through without reading any body. Bodies are read as the entries
+    are used, so making a PDF from a store holds one body at a time rather
+    than every entry.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, entries, info=None):
+        """
+        Store entries, replacing anything stored before, with the dictionary
+        info about where they came from. The entries are written as they
+        are received and not kept. Returns counts of the sections, entries,
+        and bytes of body stored.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        counts = {'sections': 0, 'entries': 0, 'body_bytes': 0}
+
+        # The bodies are written under a temporary name, so an earlier store
+        # can still be read until the new one is complete
+        fd, tmppath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as bodies:
+                tree = self._write(entries, bodies, counts)
+            os.chmod(tmppath, 0o644)
+            os.rename(tmppath, os.path.join(self.path, BODIES))
+        except:
+            os.remove(tmppath)
+            raise
+
+        write_json(os.path.join(self.path, TREE), {
+            'version': VERSION,
+            'stored': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'info': info or {},
+            'counts': counts,
+            'entries': tree,
+        })
+        return counts
+
+    def _write(self, entries, bodies, counts):
+        tree = []
+        for entry in entries:
+            record = dict((k, v) for k, v in entry.iteritems() if k not in ('body', 'topics'))
+            body = (entry.get('body') or '').encode('utf-8')
+            record['body'] = [bodies.tell(), len(body)]
+            bodies.write(body)
+            counts['body_bytes'] += len(body)
+
+            if entry.has_key('section'):
+                counts['sections'] += 1
+                record['topics'] = self._write(entry['topics'], bodies, counts)
+            else:
+                counts['entries'] += 1
+            tree.append(record)
+        return tree
+
+    def read(self):
+        """
+        The contents of tree.json: the entries without their bodies under
+        'entries', and the info and counts given when they were stored.
+        Raises StoreError if there is no store.
+        """
+        try:
+            with open(os.path.join(self.path, TREE), 'r') as infile:
+                stored = json.load(infile)
+        except (IOError, ValueError) as e:
+            raise StoreError('Error: Could not read entries store in {}: {}'.format(self.path, e))
+        if stored.get('version') != VERSION:
+            raise StoreError('Error: Unknown entries store version {}'.format(stored.get('version')))
+        return stored
+
+    def entries(self, tree=None):
+        """
+        Yield the entries of the tree, or of the whole store if none is
+        given, with their bodies. The topics of a section are a generator
+        reading them as they are used, and so can be iterated over once.
+        """
+        if tree is None:
+            tree = self.read()['entries']
+        with open(os.path.join(self.path, BODIES), 'rb') as bodies:
+            for record in tree:
+                entry = dict(record)
+                offset, length = record['body']
+                bodies.seek(offset)
+                entry['body'] = bodies.read(length).decode('utf-8')
+                if record.has_key('section'):
+                    entry['topics'] = self.entries(record['topics'])
+                yield entry
+
+def fetch_main(argv):
+    """
+    Fetch entries from Zendesk into a store, given the command line
+    arguments after "fetch". Returns the exit status.
+    """
+    import argparse
+    from .selection import OPTIONS
+    from .zdf2pdf import (UsageError, unicode_store, zendesk_arguments,
+                          command_state, section_state, zendesk, check_state,
+                          gather_entries)
+
+    UnicodeStore = unicode_store()
+    argp = argparse.ArgumentParser(prog='zdf2pdf fetch',
+        description='''Fetch entries from Zendesk into a store, to make PDFs
+        from with zdf2pdf render.''')
+    argp.add_argument('store', metavar='STORE',
+        help='Directory to keep the entries in')
+    argp.add_argument('--categories', action=UnicodeStore, dest='categories',
+        help='Comma separated Category IDs to fetch')
+    argp.add_argument('--forums', action=UnicodeStore, dest='forums',
+        help='Comma separated Forum IDs to fetch')
+    argp.add_argument('--topics', action=UnicodeStore, dest='topics',
+        help='Comma separated Topic (Entry) IDs to fetch')
+    argp.add_argument('-r', action=UnicodeStore, dest='run_section',
+        help='Fetch the entries of a pre-configured section in configuration file')
+    argp.add_argument('--category-sections', action='store_true',
+        dest='category_sections',
+        help='Make categories sections (default: false)')
+    argp.add_argument('--forum-sections', action='store_true',
+        dest='forum_sections',
+        help='Make forums sections (default: false)')
+    argp.add_argument('--topics-heading', action=UnicodeStore,
+        dest='topics_heading',
+        help='Heading to put at start of topics retrieved individually')
+    zendesk_arguments(argp)
+    state, args = command_state(argp, argv)
+
+    try:
+        if args.run_section:
+            section_state(state, args.run_section, args.config_file)
+        # Only Zendesk is fetched from, and the topics received are kept in
+        # the store so fetching again only gets what has changed. Every entry
+        # is stored, to be chosen from when rendering.
+        for k in OPTIONS:
+            state[k] = None
+        state['json_file'] = None
+        state['store'] = None
+        state['list_zdf'] = None
+        state['work_dir'] = args.store
+        if not (state['categories'] or state['forums'] or state['topics']):
+            raise UsageError('Error: Give --categories, --forums, or --topics to fetch')
+        zd = zendesk(state)
+        check_state(state)
+        start = time.time()
+        store = EntryStore(args.store)
+        counts = store.write(gather_entries(zd, state),
+                             dict((k, state[k]) for k in
+                                  ['url', 'categories', 'forums', 'topics', 'topics_heading',
+                                   'category_sections', 'forum_sections']))
+    except UsageError as e:
+        print(e)
+        return 1
+
+    print('Stored {} entries in {} sections, {} bytes of body, in {} ({:.1f}s)'.format(
+          counts['entries'], counts['sections'], counts['body_bytes'], args.store,
+          time.time() - start))
+    if state['verbose']:
+        print('Entry cache: {} topics unchanged, {} new or updated'.format(
+              zd.cache.unchanged, zd.cache.changed))
+    return 0
+
+def render_main(argv):
+    """
+    Make a PDF from a store, given the command line arguments after
+    "render": the store, and then any options of zdf2pdf. Returns the exit
+    status.
+    """
+    from .zdf2pdf import main
+
+    if argv and not argv[0].startswith('-'):
+        argv = ['--store', argv[0]] + argv[1:]
+    return main(['zdf2pdf render'] + argv)
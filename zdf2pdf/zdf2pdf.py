@@ -2,60 +2,709 @@
 zdf2pdf: Create PDFs from Zendesk forums and entries
 """
 from __future__ import unicode_literals
-import os, shutil, re, textwrap
+import os, shutil, re, textwrap, itertools, time
 import codecs
 import configparser
 import simplejson as json
 
-def process_entries(entries, entry_ids=[], body='', toc=''):
+class EntryIndex(object):
+    """
+    The entries and sections included in a document, by ID, with the anchor
+    and title of each. Used to point links between entries at the PDF
+    anchors. A new index is built for each document.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def add(self, entry_id, title):
+        self.entries[entry_id] = ('#{}'.format(entry_id), title)
+
+    def anchor(self, entry_id):
+        return self.entries[entry_id][0]
+
+    def title(self, entry_id):
+        return self.entries[entry_id][1]
+
+    def __contains__(self, entry_id):
+        return entry_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+def process_entries(entries, index=None, body='', toc=''):
+    """
+    Build the HTML body and table of contents for entries, adding them to the
+    given EntryIndex index, body, and toc. A new index is made if none is
+    given. Returns a tuple of the three.
+    """
+    if index is None:
+        index = EntryIndex()
+    body = [body]
+    toc = [toc]
+    build_entries(entries, index, body, toc)
+
+    # Join the fragments once, rather than building up long strings as we go
+    return (index, ''.join(body), ''.join(toc))
+
+def build_entries(entries, index, body, toc, sink=None):
+    """
+    Append the HTML fragments for entries to the lists body and toc, and add
+    the entries to the EntryIndex index. If given, sink is called with each
+    record of the entries in the NDJSON form read by read_entries, as the
+    entries are used.
+    """
     for entry in entries:
-        # Keep a list of entry IDs that are included in this doc so relative
-        # links can be fixed.
-        entry_ids.append(entry['id'])
+        # Keep an index of the entries that are included in this doc so
+        # relative links can be fixed.
+        index.add(entry['id'], entry['section'] if entry.has_key('section') else entry['title'])
 
         if entry.has_key('section'):
             # This is a section containing sub-entries
-            body += '<a name="{}"></a><h1>{}</h1>\n'.format(entry['id'], entry['section'])
-            body += entry['body'] + '\n'
-            
+            if sink:
+                sink(dict((k, v) for k, v in entry.iteritems() if k != 'topics'))
+            body.append('<a name="{}"></a><h1>{}</h1>\n'.format(entry['id'], entry['section']))
+            body.append(entry['body'] + '\n')
+
             # Put the section in the table of contents, starting a new list
-            toc += '<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['section'])
-            toc += '<ol>\n'
+            toc.append('<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['section']))
+            toc.append('<ol>\n')
 
-            entry_ids, body, toc = process_entries(entry['topics'], entry_ids, body, toc)
+            build_entries(entry['topics'], index, body, toc, sink)
 
-            toc += '<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['section'])
-            toc += '</ol>\n'
+            toc.append('<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['section']))
+            toc.append('</ol>\n')
+            if sink:
+                sink({'end_section': True})
         else:
             # This is an entry
+            if sink:
+                sink(entry)
             # Get the body of the entry
-            body += '<a name="{}"></a><h1>{}</h1>\n'.format(entry['id'], entry['title'])
-            body += entry['body'] + '\n'
+            body.append('<a name="{}"></a><h1>{}</h1>\n'.format(entry['id'], entry['title']))
+            body.append(entry['body'] + '\n')
 
             # Put the entry in the table of contents
-            toc += '<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['title'])
+            toc.append('<li><a href="#{}">{}</a></li>\n'.format(entry['id'], entry['title']))
+
+def pool_map(func, items, workers=1):
+    """
+    Map func over items using up to the given number of worker threads.
+    Results are returned in the same order as items. With a single worker,
+    or a single item, everything runs in the calling thread.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    if workers > 1 and len(items) > 1:
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [func(item) for item in items]
+
+class EntryStream(list):
+    """
+    A list of entries that fills itself in from an iterable as it is iterated
+    over, such as topics still arriving from Zendesk. Once the iterable is
+    used up it is an ordinary list, and so can be saved with json.dumps.
+    Only iteration and truth testing pull in more entries. Everything pulled
+    in is kept, so this is only for entries that are used more than once.
+    """
+    def __init__(self, iterable=()):
+        list.__init__(self)
+        self._source = iter(iterable)
+
+    def _pull(self):
+        if self._source is not None:
+            try:
+                self.append(next(self._source))
+                return True
+            except StopIteration:
+                self._source = None
+        return False
+
+    def __iter__(self):
+        i = 0
+        while i < list.__len__(self) or self._pull():
+            yield list.__getitem__(self, i)
+            i += 1
+
+    def __nonzero__(self):
+        return list.__len__(self) > 0 or self._pull()
+
+def read_entries(path):
+    """
+    Yield the entries in the file at path, reading it as it goes.
+
+    The file may be a JSON list of entries, whose entries are read one at a
+    time with ijson if it is installed. Otherwise it is NDJSON, one JSON
+    object per line: an entry, or a section without its topics followed by
+    the records of its topics and then {"end_section": true}. The topics of
+    a section from NDJSON are a generator reading them from the file as they
+    are used, and so can be iterated over once. Topics that are not used are
+    skipped over before going on past the section.
+    """
+    with open(path, 'r') as infile:
+        start = infile.read(64).lstrip()
+        infile.seek(0)
+        if start.startswith('['):
+            try:
+                import ijson
+                entries = ijson.items(infile, 'item')
+            except ImportError:
+                entries = json.load(infile)
+        else:
+            entries = _ndjson_entries(infile)
+
+        for entry in entries:
+            yield entry
+
+def _ndjson_entries(lines):
+    # Yield entries from the iterator lines until the end of the section
+    # being read. A section's topics are read through lines too, so whatever
+    # of them hasn't been used is read past before going on.
+    section = None
+    while True:
+        if section is not None:
+            for entry in section['topics']:
+                pass
+            section = None
+
+        line = next(lines, None)
+        if line is None:
+            return
+        if not line.strip():
+            continue
+
+        record = json.loads(line)
+        if record.get('end_section'):
+            return
+        if record.has_key('section'):
+            section = record
+            section['topics'] = _ndjson_entries(lines)
+        yield record
+
+def ndjson_writer(outfile):
+    """
+    Return a build_entries sink that writes records to outfile as NDJSON.
+    """
+    def write(record):
+        outfile.write(json.dumps(record))
+        outfile.write('\n')
+    return write
+
+def prefetch(pool, func, *args):
+    """
+    Run the generator function func(*args) as a task in the given thread pool
+    and return a generator over the items it produces, available as soon as
+    they are produced. Exceptions in func are raised by the returned
+    generator.
+    """
+    import sys, Queue
+
+    queue = Queue.Queue()
+    def produce():
+        try:
+            for item in func(*args):
+                queue.put((True, item))
+            queue.put((False, None))
+        except Exception:
+            queue.put((False, sys.exc_info()))
+
+    pool.apply_async(produce)
+
+    def consume():
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item:
+                    raise item[0], item[1], item[2]
+                return
+            yield item
+
+    return consume()
+
+def harvest(zd, cat_ids, forum_ids, opts, workers=1):
+    """
+    Get the entries from the given Zendesk categories and forums, running
+    independent requests concurrently with up to workers threads. Returns an
+    iterator over entries and sections in the same order and nesting that
+    walking the categories and then the forums one at a time would give. The
+    topics of a section are an iterator too, and so can be used once.
+
+    The categories and forums are looked up before returning. The topics of
+    every forum are then fetched in the background, page by page, and can be
+    used as they arrive.
+    """
+    # First get the list of forums in each category, and the category itself
+    # if it is going to be a section
+    def get_category(cat_id):
+        if opts['verbose']:
+            print('Obtaining entries from category {}'.format(cat_id))
+        forums = list(zd.list_category_forums(cat_id))
+        if opts['category_sections']:
+            cat = zd.show_category(cat_id)
+        else:
+            cat = None
+        return (cat, forums)
+
+    categories = pool_map(get_category, cat_ids, workers)
+
+    # Forums given directly are looked up if they are going to be sections,
+    # categories already provided their forums.
+    if opts['forum_sections']:
+        forums = pool_map(zd.show_forum, forum_ids, workers)
+    else:
+        forums = [None for forum_id in forum_ids]
+
+    # Then start getting the topics in every forum, from categories and given
+    # directly, all at once
+    def list_topics(forum_id):
+        if opts['verbose']:
+            print('Obtaining entries from forum {}'.format(forum_id))
+        return zd.list_topics(forum_id)
+
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        topics = lambda forum_id: prefetch(pool, list_topics, forum_id)
+    else:
+        pool = None
+        topics = list_topics
+
+    def forum_entries(forum_id, forum):
+        if opts['forum_sections']:
+            return [{'section': forum['name'],
+                     'id': forum['id'],
+                     'body': forum['description'],
+                     'topics': topics(forum_id)}]
+            # result:
+            # [
+            #   {
+            #     'section':'FORUM TITLE',
+            #     'id': 'FORUM ID',
+            #     'body': 'FORUM DESCRIPTION',
+            #     'topics':
+            #       [
+            #         {entry},
+            #         ...
+            #         {entry}
+            #       ]
+            #   }
+            # ]
+        else:
+            return topics(forum_id)
+            # result:
+            # [
+            #   {entry},
+            #   ...
+            #   {entry}
+            # ]
+
+    # Build the entries as a list of iterables of entries, chained together
+    # at the end so that nothing here waits on the topics to arrive
+    entries = []
+    for cat_id, (cat, cat_forums) in zip(cat_ids, categories):
+        cat_entries = itertools.chain.from_iterable(
+            [forum_entries(forum['id'], forum) for forum in cat_forums])
+
+        if opts['category_sections']:
+            entries.append([{'section': cat['name'],
+                             'id': cat_id,
+                             'body': cat['description'],
+                             'topics': cat_entries}])
+            # result if forum sections:
+            # entries = [
+            #             <previous categories,>
+            #             {
+            #               'section': 'CATEGORY TITLE',
+            #               'id': 'CATEGORY ID',
+            #               'body': 'CATEGORY DESCRIPTION',
+            #               'topics':
+            #                 [
+            #                   {
+            #                     'section':'FORUM TITLE',
+            #                     'topics':
+            #                       [
+            #                         {entry},
+            #                         ...
+            #                         {entry}
+            #                       ]
+            #                   }
+            #                 ]
+            #             }
+            #           ]
+            #
+            # result if not forum sections:
+            # entries = [
+            #             <previous categories,>
+            #             {
+            #               'section':'CATEGORY TITLE',
+            #               'topics':
+            #                 [
+            #                   {entry},
+            #                   ...
+            #                   {entry}
+            #                 ]
+            #             }
+            #           ]
+        else:
+            entries.append(cat_entries)
+            # result: whatever cat_entries was (forums as sections or not)
+            #         is concatenated onto the end of entries
+
+    for forum_id, forum in zip(forum_ids, forums):
+        entries.append(forum_entries(forum_id, forum))
+
+    if pool:
+        # Let the pool threads finish once all of the topics are in
+        pool.close()
+
+    return itertools.chain.from_iterable(entries)
+
+def fetch_attachments(srcs, attach_dir, cache, workers=1):
+    """
+    Get each of the given URLs through the AttachmentCache cache using a pool
+    of worker threads, and place the files in attach_dir named by the hash of
+    their contents.
+
+    Returns a tuple of a dictionary mapping each fetched URL to its local
+    filename, and a list of (URL, error) tuples for any downloads that failed.
+    """
+    from .attach import link_or_copy
+
+    def fetch(src):
+        try:
+            objfile = cache.fetch(src)
+            srcfile = os.path.join(attach_dir, os.path.basename(objfile))
+            if not os.path.isfile(srcfile):
+                link_or_copy(objfile, srcfile)
+        except Exception as e:
+            return (src, None, e)
+
+        return (src, srcfile, None)
+
+    results = pool_map(fetch, srcs, workers)
+    cache.save()
+
+    srcfiles = dict((src, srcfile) for src, srcfile, err in results if not err)
+    errors = [(src, err) for src, srcfile, err in results if err]
+
+    return (srcfiles, errors)
+
+class Transform(object):
+    """
+    A change made to the document after it is parsed into a BeautifulSoup.
+
+    The soup is traversed once for all transforms. handle(tag) is called for
+    every tag whose name is in tags, in document order, or for every tag if
+    tags is True. start(soup, opts) is called before the traversal and
+    finish(soup) after it, in the order the transforms were given.
+
+    Custom transforms subclass Transform and are named with the transforms
+    option as comma separated module.ClassName paths. They are created with
+    no arguments.
+    """
+    tags = ()
+    # Counts for the profile report, such as the number of tags changed. Each
+    # transform is given a dictionary of its own before start is called.
+    counts = None
+
+    @property
+    def name(self):
+        return self.__class__.__name__
+
+    def start(self, soup, opts):
+        pass
+
+    def handle(self, tag):
+        pass
+
+    def finish(self, soup):
+        pass
+
+class PreWrapTransform(Transform):
+    """
+    Wrap the contents of <pre> tags to a width, see wrap_pre.
+    """
+    tags = ('pre',)
+
+    def __init__(self, width):
+        self.width = width
+
+    def handle(self, pre):
+        wrap_pre(pre, self.width)
+
+class ImageTransform(Transform):
+    """
+    Get images and display them inline. The unique image URLs are collected
+    during the traversal so each one is downloaded only once, fetched
+    concurrently once it is done, and then the tags are pointed at the local
+    files.
+
+    Images that can't be fetched are replaced by their alt text, or removed
+    if they have none.
+
+    If an ImageOptimizer is given, the downloaded images are shrunk by it, and
+    tags without a width or height are given those of the original image so
+    the document is laid out the same.
+    """
+    tags = ('img',)
+
+    def __init__(self, attach_dir, cache, workers=1, optimizer=None):
+        self.attach_dir = attach_dir
+        self.cache = cache
+        self.workers = workers
+        self.optimizer = optimizer
+
+    def start(self, soup, opts):
+        import urlparse
+        self.urljoin = urlparse.urljoin
+        self.url = opts['url']
+        self.imgs = []
+        self.srcs = []
+        self.seen = set()
+        self.srcfiles = {}
+
+    def handle(self, img):
+        try:
+            # Handle relative and absolute img src
+            src = self.urljoin(self.url, img['src'])
+        except KeyError:
+            # this img tag doesn't have a src
+            return
+        self.imgs.append((img, src))
+        if src not in self.seen:
+            self.seen.add(src)
+            self.srcs.append(src)
+
+    def finish(self, soup):
+        srcfiles, errors = fetch_attachments(self.srcs, self.attach_dir,
+                                             self.cache, self.workers)
+        self.srcfiles = srcfiles
+
+        replaced = {}
+        if self.optimizer and srcfiles:
+            replaced, bad = self.optimizer.optimize(srcfiles.values())
+            for srcfile, err in bad:
+                print('Warning: Could not optimize image {}: {}'.format(srcfile, err))
+
+        for img, src in self.imgs:
+            # Update the tag for the local filepath
+            if srcfiles.has_key(src):
+                img['src'] = srcfiles[src]
+                if replaced.has_key(srcfiles[src]):
+                    img['src'], (width, height) = replaced[srcfiles[src]]
+                    if not img.has_attr('width') and not img.has_attr('height'):
+                        img['width'] = unicode(width)
+                        img['height'] = unicode(height)
+            elif img.get('alt'):
+                # Left as it is, xhtml2pdf would try to fetch an image that
+                # could not be fetched again itself, so show its alt text
+                img.replace_with(img['alt'])
+            else:
+                img.decompose()
+
+        self.counts = {'images': len(self.imgs), 'urls': len(self.srcs),
+                       'failed': len(errors), 'optimized': len(replaced)}
+
+        if errors:
+            print('Error: Could not fetch {} of {} images:'.format(len(errors), len(self.srcs)))
+            for src, err in errors:
+                print('    {}: {}'.format(src, err))
+
+class LinkTransform(Transform):
+    """
+    Make relative links to entries and absolute links to entries point to PDF
+    anchors. e.g.
+    http://example.zendes.com/entries/21473796-title
+    /entries/21473796-title
+    TODO /entries/21473796-title#anchor
+    """
+    tags = ('a',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def start(self, soup, opts):
+        self.r = re.compile('(?:' + (opts['url'] or '') + ')?/entries/([0-9]*)-.*')
+
+    def handle(self, a):
+        try:
+            m = self.r.match(a['href'])
+            # modify the link if we have a match and the entry is in the PDF
+            if m and int(m.group(1)) in self.index:
+                a['href'] = self.index.anchor(int(m.group(1)))
+        except KeyError:
+            # this a tag doesn't have an href. named anchor only?
+            pass
+
+class ChunkLinkTransform(Transform):
+    """
+    Mark links to entries and the entry headings they point to, so they can
+    be linked up once a document rendered in chunks is merged, see
+    zdf2pdf.render.
+    """
+    tags = ('a',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def start(self, soup, opts):
+        from .render import LINK_SCHEME, ANCHOR_SCHEME
+        self.link_scheme = LINK_SCHEME
+        self.anchor_scheme = ANCHOR_SCHEME
+        self.soup = soup
+        self.ids = set('{}'.format(entry_id) for entry_id in self.index)
+
+    def handle(self, a):
+        href = a.get('href')
+        if href:
+            if href[0] == '#' and href[1:] in self.ids:
+                a['href'] = self.link_scheme + href[1:]
+        elif a.get('name') in self.ids:
+            # Put a blank link at the end of the heading following the anchor
+            # so it doesn't move the heading's text
+            marker = self.soup.new_tag('a', href=self.anchor_scheme + a['name'])
+            marker.string = '\xa0'
+            heading = a.find_next_sibling()
+            if heading is not None and heading.name == 'h1':
+                heading.append(marker)
+            else:
+                a.insert_after(marker)
+
+class StripEmptyTransform(Transform):
+    """
+    Strip out tags that do not have any contents, see strip_empty_tags.
+    """
+    def finish(self, soup):
+        strip_empty_tags(soup)
+
+def load_transforms(names):
+    """
+    Create the custom transforms named by a comma separated string of
+    module.ClassName paths.
+    """
+    import importlib
+
+    transforms = []
+    for name in names.split(','):
+        name = name.strip()
+        if name:
+            module, cls = name.rsplit('.', 1)
+            transforms.append(getattr(importlib.import_module(module), cls)())
+    return transforms
+
+def run_transforms(soup, transforms, opts, profiler=None):
+    """
+    Apply transforms to soup with a single traversal of the soup. Returns a
+    list of (name, seconds) tuples with the time taken by each transform.
+    A transform is run under cProfile if the Profiler profiler asks for it.
+    """
+    times = dict((id(t), 0.0) for t in transforms)
+    profiles = dict((id(t), profiler.cprofile(t.name) if profiler else None)
+                    for t in transforms)
+    def timed(t, method, *args):
+        prof = profiles[id(t)]
+        start = time.time()
+        if prof:
+            prof.enable()
+        method(*args)
+        if prof:
+            prof.disable()
+        times[id(t)] += time.time() - start
+
+    # Gather the transforms by the tags they handle
+    handlers = {}
+    every = [t for t in transforms if t.tags is True]
+    for t in transforms:
+        if t.tags is not True:
+            for tag_name in t.tags:
+                handlers.setdefault(tag_name, []).append(t)
+
+    for t in transforms:
+        if t.counts is None:
+            t.counts = {}
+        timed(t, t.start, soup, opts)
+
+    if every or handlers:
+        for tag in soup.find_all(True if every else handlers.keys()):
+            for t in every + handlers.get(tag.name, []):
+                timed(t, t.handle, tag)
+
+    for t in transforms:
+        timed(t, t.finish, soup)
+
+    return [(t.name, times[id(t)]) for t in transforms]
+
+# A self-closing pdf: tag, such as <pdf:pagenumber/>
+PDF_TAG_RE = re.compile(r'<(pdf:[\w-]+)([^<>]*?)\s*/>', re.IGNORECASE)
+
+def close_pdf_tags(html):
+    """
+    html with its self-closing pdf: tags written with end tags. html5lib
+    doesn't know these tags, and would otherwise put everything after one
+    inside it.
+    """
+    return PDF_TAG_RE.sub(r'<\1\2></\1>', html)
 
-    return (entry_ids, body, toc)
+def html_parser(name=None):
+    """
+    The name of the parser BeautifulSoup should use. lxml is used if it is
+    installed and no parser is named, as it is much faster than html.parser.
+    """
+    if name:
+        return name
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
 
-def zdf2pdf(entries, opts):
+def zdf2pdf(entries, opts, profiler=None):
+    """
+    Make the PDF described by opts from entries. The time taken by each stage
+    is recorded in the Profiler profiler if one is given.
+    """
     from bs4 import BeautifulSoup
-    import urllib, urlparse
-    import xhtml2pdf.pisa as pisa
+    from .attach import AttachmentCache
+    from .session import HTTPSession
+    from .profiling import Profiler
+    from . import render, snapshot
     try:
         import cStringIO as SIO
     except ImportError:
         import StringIO as SIO
 
+    if profiler is None:
+        profiler = Profiler()
+
     # Save the current directory so we can go back once done
     startdir = os.getcwd()
 
-    # Start the xhtml to be converted
-    data = '<head>\n'
+    # Start the xhtml to be converted. Fragments are collected in a list and
+    # joined once everything is in. The document is complete, so every parser
+    # gives it the same <html> and <body>.
+    data = ['<html><head>\n']
+
+    # Render in chunks with several worker processes, or to only render the
+    # chunks that have changed
+    chunked = (opts.get('render_workers') or 1) > 1 or opts.get('incremental')
+
+    # Keep one form of the document in memory at a time, on disk otherwise
+    low_memory = opts.get('low_memory')
 
     # Normalize all of the given paths to absolute paths
     opts['output_file'] = os.path.abspath(opts['output_file'])
     opts['work_dir'] = os.path.abspath(opts['work_dir'])
     attach_dir = os.path.join(opts['work_dir'], 'attach')
+    if opts.get('attach_cache'):
+        opts['attach_cache'] = os.path.abspath(opts['attach_cache'])
 
     # Check for and create working directory
     if not os.path.isdir(opts['work_dir']):
@@ -67,17 +716,17 @@ def zdf2pdf(entries, opts):
 
     # Save the running configuration for rerunning
     parser = configparser.SafeConfigParser()
-    config_opts = dict((k, v) for k, v in opts.iteritems() if (k != 'json_file'
+    config_opts = dict((k, v) for k, v in opts.iteritems() if (k != 'json_file' and k != 'store'
                       and k != 'categories' and k != 'forums' and k != 'topics'
                       and k != 'run_section' and k != 'list_zdf' and k != 'work_dir'
                       and k != 'delete' and k != 'url' and k != 'mail' and k != 'password'
-                      and k != 'is_token' and v != None
+                      and k != 'is_token' and k != 'from_snapshot' and v != None
                       ))
     if config_opts.has_key('style_file'):
         config_opts['style_file'] = os.path.basename(config_opts['style_file'])
     if config_opts.has_key('output_file'):
         config_opts['output_file'] = os.path.basename(config_opts['output_file'])
-    config_opts['json_file'] = 'entries.json'
+    config_opts['json_file'] = 'entries.ndjson'
 
     parser.add_section('zdf2pdf')
     for k, v in config_opts.iteritems():
@@ -88,17 +737,20 @@ def zdf2pdf(entries, opts):
     if opts['style_file']:
         # Save the style file in the working directory
         shutil.copy(opts['style_file'], opts['work_dir'])
-        data += """<link rel="stylesheet" type="text/css"
-                   href="{}" />\n""".format(os.path.basename(opts['style_file']))
+        data.append("""<link rel="stylesheet" type="text/css"
+                   href="{}" />\n""".format(os.path.basename(opts['style_file'])))
 
-    data += '</head>\n<body>\n'
+    data.append('</head>\n<body>\n')
 
     # Add PDF header if given
     if opts['header']:
-        data += opts['header'] + '\n'
+        data.append(close_pdf_tags(opts['header']) + '\n')
 
     if opts['footer']:
-        data += opts['footer'] + '\n'
+        data.append(close_pdf_tags(opts['footer']) + '\n')
+
+    if chunked:
+        data.append(render.FRAMES_MARKER + '\n')
 
     # Build anything provided that should go on the title page
     if opts['title'] or opts['author'] or opts['date'] or opts['copyright']:
@@ -107,137 +759,465 @@ def zdf2pdf(entries, opts):
         else:
             title_class = ''
 
-        data += '<div{}>\n'.format(title_class)
+        data.append('<div{}>\n'.format(title_class))
 
         if opts['title']:
-            data += '<h1>{}</h1>\n'.format(opts['title'])
+            data.append('<h1>{}</h1>\n'.format(opts['title']))
 
         if opts['author']:
-            data += '<div>{}</div>\n'.format(opts['author'])
+            data.append('<div>{}</div>\n'.format(opts['author']))
 
         if opts['date']:
-            data += '<div>{}</div>\n'.format(opts['date'])
+            data.append('<div>{}</div>\n'.format(opts['date']))
 
         if opts['copyright']:
-            data += '<div>{}</div>\n'.format(opts['copyright'])
-
-        data += '</div>\n'
-
-    # Go through the JSON and build a toc and body to add to the html data
-    entry_ids, body, toc = process_entries(entries)
-
-    # Put all of the body after the table of contents
-    if opts['toc']:
-        if opts['toc_class']:
-            toc_class = ' class="{}"'.format(opts['toc_class'])
+            data.append('<div>{}</div>\n'.format(opts['copyright']))
+
+        data.append('</div>\n')
+
+    # Go through the JSON and build a toc and body to add to the html data.
+    # The entries are saved as they go by.
+    with profiler.stage('assemble') as counts:
+        index = EntryIndex()
+        if low_memory:
+            import tempfile
+            body_file = tempfile.TemporaryFile(dir=opts['work_dir'])
+            body = FragmentFile(body_file)
         else:
-            toc_class = ''
-        data += '<div{}>\n<h2>{}</h2>\n<ol>\n'.format(toc_class, opts['toc_title'])
-        data += toc
-        data += '</ol>\n</div>\n'
-    data += body
+            body = []
+        toc = []
+        with open(os.path.join(opts['work_dir'], 'entries.ndjson'), 'w') as outfile:
+            sink = ndjson_writer(outfile)
+            if chunked:
+                # Mark where each top level entry or section starts
+                for entry in entries:
+                    body.append(render.CHUNK_MARKER + '\n')
+                    build_entries([entry], index, body, toc, sink)
+            else:
+                build_entries(entries, index, body, toc, sink)
+            counts['ndjson_bytes'] = outfile.tell()
+        body.append('</body></html>')
+
+        # Put all of the body after the table of contents
+        if opts['toc']:
+            if opts['toc_class']:
+                toc_class = ' class="{}"'.format(opts['toc_class'])
+            else:
+                toc_class = ''
+            data.append('<div{}>\n<h2>{}</h2>\n<ol>\n'.format(toc_class, opts['toc_title']))
+            data.extend(toc)
+            data.append('</ol>\n</div>\n')
+        toc = None
+        if low_memory:
+            # Put the body after the rest on disk, and read the whole
+            # document in once
+            with tempfile.TemporaryFile(dir=opts['work_dir']) as doc_file:
+                doc_file.write(''.join(data).encode('utf-8'))
+                body_file.seek(0)
+                shutil.copyfileobj(body_file, doc_file)
+                body_file.close()
+                doc_file.seek(0)
+                data = doc_file.read().decode('utf-8')
+        else:
+            data.extend(body)
+            data = ''.join(data)
+        body = None
+        counts['entries'] = len(index)
+        counts['html_chars'] = len(data)
 
     # Change to working directory to begin file output
     os.chdir(opts['work_dir'])
 
-    # Save entries
-    with open('entries.json', "w") as outfile:
-        outfile.write(json.dumps(entries))
-
     # Make the data a traversable beautifulsoup
-    soup = BeautifulSoup(data)
-
+    parser = html_parser(opts.get('html_parser'))
+    with profiler.stage('parse', parser=parser):
+        soup = BeautifulSoup(data, parser)
+        data = None
+    if opts['verbose']:
+        print('Parsing HTML with {} took {:.3f}s'.format(parser, profiler.stages[-1]['seconds']))
+
+    # Make all of the changes to the soup in one pass through it
+    transforms = []
     if opts['pre_width']:
-        # Monkey patch TextWrapper for splitting on any whitespace and add
-        # splitting on commas. Save the old one for when we're done.
-        old_wordsep_simple_re = textwrap.TextWrapper.wordsep_simple_re
-        new_wordsep_simple_re = re.compile(r'(\s+|\,)')
-        textwrap.TextWrapper.wordsep_simple_re = new_wordsep_simple_re
-
-        w = textwrap.TextWrapper(width=opts['pre_width'],
-                replace_whitespace=False, drop_whitespace=False,
-                break_on_hyphens=False, break_long_words=True)
-        for pre in soup.find_all('pre'):
-            pre_str = ''
-            try:
-                for line in pre.string.splitlines():
-                    pre_str += '\n'.join(w.wrap(line)) + '\n'
-                pre.string = pre_str
-            except AttributeError:
-                # pre tag has no content
-                pass
+        transforms.append(PreWrapTransform(opts['pre_width']))
+
+    attach_cache = opts.get('attach_cache') or os.path.join(opts['work_dir'], 'attach-cache')
+    max_age = (opts.get('attach_cache_age') or 0) * 24 * 60 * 60
+    if opts.get('from_snapshot'):
+        # Images come from the snapshot rather than the network
+        cache = snapshot.SnapshotAttachments(opts['from_snapshot'],
+                    snapshot.read_manifest(opts['from_snapshot'], verify=False))
+    else:
+        # Images from the Zendesk host are fetched with the Zendesk login, so
+        # private attachments can be had
+        session = HTTPSession(opts['url'], opts.get('mail'), opts.get('password'),
+                              opts.get('is_token'))
+        cache = AttachmentCache(attach_cache,
+                                max_size=(opts.get('attach_cache_size') or 0) * 1024 * 1024,
+                                max_age=max_age, session=session)
+    optimizer = None
+    if opts.get('image_max_width') or opts.get('image_quality') or opts.get('image_grayscale'):
+        from .images import ImageOptimizer
+        optimizer = ImageOptimizer(os.path.join(attach_cache, 'optimized'),
+                                   max_width=opts.get('image_max_width'),
+                                   quality=opts.get('image_quality'),
+                                   grayscale=opts.get('image_grayscale'),
+                                   max_age=max_age)
+    images = ImageTransform(attach_dir, cache, opts.get('fetch_workers', 1), optimizer)
+    transforms.append(images)
+    transforms.append(LinkTransform(index))
+
+    if opts.get('transforms'):
+        transforms += load_transforms(opts['transforms'])
 
-        # Put the original wordsep_simple_re back
-        textwrap.TextWrapper.wordsep_simple_re = old_wordsep_simple_re
+    if opts['strip_empty']:
+        transforms.append(StripEmptyTransform())
+
+    if chunked:
+        transforms.append(ChunkLinkTransform(index))
+
+    with profiler.stage('transforms'):
+        times = run_transforms(soup, transforms, opts, profiler)
+        cache.prune()
+        if optimizer:
+            optimizer.prune()
+        for t, (name, seconds) in zip(transforms, times):
+            profiler.add(name, seconds, **t.counts)
+
+    if opts['verbose']:
+        for name, seconds in times:
+            print('{} took {:.3f}s'.format(name, seconds))
+        if optimizer:
+            print('Image optimizer: {} images reused, {} optimized'.format(
+                  optimizer.hits, optimizer.misses))
+
+    with profiler.stage('serialize') as counts:
+        if low_memory:
+            # Write the html a tag at a time, and let go of the soup, which
+            # is only freed once its reference cycles are broken
+            with open('entries.html', 'wb') as outfile:
+                write_html(soup, outfile)
+                counts['html_bytes'] = outfile.tell()
+            soup.decompose()
+            soup = None
+            html = None
+        else:
+            html = soup.encode('utf-8')
+
+            # Save generated html
+            with open('entries.html', "w") as outfile:
+                outfile.write(html)
+            counts['html_bytes'] = len(html)
+
+    with profiler.stage('render') as counts, snapshot.reproducible(opts.get('reproducible')):
+        # Only loaded once there is something to render, and before any
+        # render workers are started so they have it already
+        import xhtml2pdf.pisa as pisa
+
+        if chunked:
+            start = time.time()
+            render_cache = None
+            if opts.get('incremental'):
+                # The stylesheet isn't part of the HTML, so changing it changes
+                # every chunk
+                salt = b''
+                if opts['style_file']:
+                    with open(os.path.basename(opts['style_file']), 'rb') as infile:
+                        salt = infile.read()
+                render_cache = render.RenderCache(os.path.join(opts['work_dir'], 'render-cache'), salt)
+
+            if html is None:
+                with open('entries.html', 'rb') as infile:
+                    html = infile.read()
+            chunks = render.split_chunks(html)
+            html = None
+            rendered = render.render_chunks(chunks, opts.get('render_workers') or 1, render_cache)
+            with open(opts['output_file'], 'wb') as outfile:
+                pages = render.merge_chunks(rendered, outfile)
+            if render_cache:
+                render_cache.prune()
+
+            counts['pages'] = pages
+            counts['chunks'] = len(chunks)
+            if opts['verbose']:
+                print('Rendering {} pages in {} chunks took {:.3f}s'.format(
+                      pages, len(chunks), time.time() - start))
+                if render_cache:
+                    print('Render cache: {} chunks reused, {} rendered'.format(
+                          render_cache.hits, render_cache.misses))
+
+            for n, ((pdf, count, err, warn, log), lead) in enumerate(rendered):
+                if err and log:
+                    for mode, line, msg, code in log:
+                        print "%s in chunk %d line %d: %s" % (mode, n, line, msg)
+                if warn:
+                    print "*** %d WARNINGS OCCURED in chunk %d" % (warn, n)
+        else:
+            if html is None:
+                # xhtml2pdf reads the html from entries.html as it goes
+                # rather than from a copy in memory
+                infile = open('entries.html', 'rb')
+            else:
+                infile = SIO.StringIO(html)
+            try:
+                with open(opts['output_file'], 'wb') as outfile:
+                    pdf = pisa.CreatePDF(
+                        infile,
+                        outfile,
+                        encoding = 'utf-8'
+                    )
+            finally:
+                infile.close()
+
+            if pdf.err and pdf.log:
+                for mode, line, msg, code in pdf.log:
+                    print "%s in line %d: %s" % (mode, line, msg)
+
+            if pdf.warn:
+                print "*** %d WARNINGS OCCURED" % pdf.warn
+        counts['pdf_bytes'] = os.path.getsize(opts['output_file'])
+
+    # Record everything that went into the PDF so it can be made again
+    config_opts['url'] = opts['url']
+    snapshot.write_manifest(opts['work_dir'], config_opts, images.srcfiles, opts['output_file'])
 
-    # Get images and display them inline
-    for img in soup.find_all('img'):
-        # Handle relative and absolute img src
-        src = urlparse.urljoin(opts['url'], img['src'])
+    os.chdir(startdir)
 
-        # Normalize the local filename
-        srcfile = os.path.join(attach_dir, src.replace('/', '_'))
+class FragmentFile(object):
+    """
+    Stands in for the list of HTML fragments given to build_entries, writing
+    each fragment to a file as UTF-8 as it is appended rather than keeping
+    it.
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
 
-        # Get this image if not already present
-        if not os.path.isfile(srcfile):
-            urllib.urlretrieve(src, srcfile)
+    def append(self, fragment):
+        self.outfile.write(fragment.encode('utf-8'))
 
-        # Update the tag for the relative filepath
-        img['src'] = srcfile
+def write_html(soup, outfile, depth=2):
+    """
+    Write soup to outfile as soup.encode('utf-8') would, a piece at a time.
+    Tags down to depth levels deep, such as <html> and <body>, are written
+    around their contents, and each tag inside them is encoded and written
+    on its own, so only one tag's html is held in memory at once.
+    """
+    from bs4 import NavigableString, Tag
+
+    formatter = soup.formatter_for_name('minimal')
+    for child in soup:
+        if isinstance(child, NavigableString):
+            outfile.write(child.output_ready(formatter).encode('utf-8', 'xmlcharrefreplace'))
+        elif isinstance(child, Tag):
+            if depth > 0 and child.contents and not child.is_empty_element:
+                # The tag's own html, empty, split around where the
+                # contents go
+                contents = child.contents
+                child.contents = []
+                try:
+                    empty = child.decode(None, 'utf-8', formatter)
+                finally:
+                    child.contents = contents
+                close = '</{}{}>'.format(child.prefix + ':' if child.prefix else '', child.name)
+                outfile.write(empty[:-len(close)].encode('utf-8', 'xmlcharrefreplace'))
+                write_html(child, outfile, depth - 1)
+                outfile.write(close.encode('utf-8'))
+            else:
+                outfile.write(child.encode('utf-8', formatter=formatter))
 
-    # Make relative links to entries and absolute links to entries point to PDF
-    # anchors. e.g.
-    # http://example.zendes.com/entries/21473796-title
-    # /entries/21473796-title
-    # TODO /entries/21473796-title#anchor
-    r = re.compile('(?:' + opts['url'] + ')?/entries/([0-9]*)-.*')
-    for a in soup.find_all('a'):
-        try:
-            m = r.match(a['href'])
-            # modify the link if we have a match and the entry is in the PDF
-            if m and int(m.group(1)) in entry_ids:
-                a['href'] = '#{}'.format(m.group(1))
-        except KeyError:
-            # this a tag doesn't have an href. named anchor only?
-            pass
+def strip_empty_tags(soup):
+    """
+    Strip out tags that do not have any contents. Intended to clean up HTML
+    produced by editors. Does not remove self closing tags, empty anchor link
+    tags, or xhtml2pdf specific tags.
 
-    if opts['strip_empty']:
-        soup = strip_empty_tags(soup)
+    Tags are visited in a single pass with every tag visited after all of
+    the tags inside it, so a tag that is left empty by removing its contents
+    is removed too.
+    """
+    from bs4 import NavigableString
 
-    html = soup.encode('utf-8')
+    emptymatches = re.compile(r'^(&nbsp;|\s)*$', re.UNICODE)
 
-    # Save generated html
-    with open('entries.html', "w") as outfile:
-        outfile.write(html)
+    # find_all gives tags in document order, where each tag comes before all
+    # of the tags inside it. Reversed, the inside tags come first.
+    for tag in reversed(soup.find_all(True)):
+        if (tag.name == 'a' or tag.name[0:3] == 'pdf' or tag.is_empty_element):
+            continue
 
-    pdf = pisa.CreatePDF(
-        SIO.StringIO(html),
-        file(opts['output_file'], "wb"),
-        encoding = 'utf-8'
-    )
+        for child in tag.contents:
+            # Anything but plain whitespace text, including comments, counts
+            # as content
+            if not (type(child) is NavigableString and emptymatches.match(child)):
+                break
+        else:
+            tag.extract()
 
-    if pdf.err and pdf.log:
-        for mode, line, msg, code in pdf.log:
-            print "%s in line %d: %s" % (mode, line, msg)
+    return soup
 
-    if pdf.warn:
-        print "*** %d WARNINGS OCCURED" % pdf.warn
+# Where <pre> lines may be broken: around runs of whitespace, and commas
+PRE_WORD_RE = re.compile(r'\s+|,', re.UNICODE)
+# The line endings of unicode.splitlines()
+PRE_LINE_RE = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
-    os.chdir(startdir)
+def wrap_pre_text(text, width):
+    """
+    Wrap each line of text to width, breaking lines before words that don't
+    fit and breaking words longer than a whole line. Words are split by
+    whitespace and commas, which are kept, and tabs are expanded. Every line
+    ends with a newline. This is what textwrap.TextWrapper does when it
+    splits on whitespace and commas and keeps the whitespace, but it only
+    goes through the text once.
+
+    Returns a list of (start, end, piece, same) tuples in order, where piece
+    is the output for text[start:end], or part of it if a word with tabs is
+    broken, and same is True if it is an unchanged copy of it. Newlines put in
+    to break lines have start equal to end.
+    """
+    out = []
+    append = out.append
+    length = len(text)
+    pos = 0
+    while pos < length:
+        m = PRE_LINE_RE.search(text, pos)
+        line_end = m.start() if m else length
+
+        if line_end - pos <= width and '\t' not in text[pos:line_end]:
+            # Fits as it is
+            if line_end > pos:
+                append((pos, line_end, text[pos:line_end], True))
+        else:
+            # The words of the line and the whitespace and commas between
+            words = []
+            start = pos
+            for sep in PRE_WORD_RE.finditer(text, pos, line_end):
+                if sep.start() > start:
+                    words.append((start, sep.start()))
+                words.append((sep.start(), sep.end()))
+                start = sep.end()
+            if start < line_end:
+                words.append((start, line_end))
+
+            # Column in the unwrapped line, for expanding tabs
+            col = 0
+            # Length of the wrapped line so far, and whether it has been ended
+            cur = 0
+            full = False
+            # Start of the unchanged text on the wrapped line not yet in out
+            run = None
+            for start, end in words:
+                piece = text[start:end]
+                same = '\t' not in piece
+                if not same:
+                    expanded = []
+                    at = col
+                    for c in piece:
+                        if c == '\t':
+                            c = ' ' * (8 - at % 8)
+                        expanded.append(c)
+                        at += len(c)
+                    piece = ''.join(expanded)
+                col += len(piece)
+
+                s = start
+                while piece:
+                    if full:
+                        if run is not None:
+                            append((run, s, text[run:s], True))
+                            run = None
+                        append((s, s, '\n', False))
+                        cur = 0
+                        full = False
+                    if cur + len(piece) <= width:
+                        if same:
+                            if run is None:
+                                run = s
+                        else:
+                            if run is not None:
+                                append((run, s, text[run:s], True))
+                                run = None
+                            append((s, end, piece, False))
+                        cur += len(piece)
+                        break
+                    if len(piece) <= width:
+                        full = True
+                        continue
+                    # A word longer than a line fills what is left of this one
+                    space = width - cur if width >= 1 else 1
+                    if same:
+                        if run is None:
+                            run = s
+                        s += space
+                    elif space:
+                        if run is not None:
+                            append((run, s, text[run:s], True))
+                            run = None
+                        append((s, end, piece[:space], False))
+                    piece = piece[space:]
+                    full = True
+            if run is not None:
+                append((run, line_end, text[run:line_end], True))
+
+        # End the line
+        if m:
+            append((line_end, m.end(), '\n', m.group() == '\n'))
+            pos = m.end()
+        else:
+            append((length, length, '\n', False))
+            pos = length
+    return out
 
-def strip_empty_tags(soup):
+def wrap_pre(pre, width):
     """
-    Strip out tags that do not have any contents. Intended to clean up HTML
-    produced by editors. Does not remove self closing tags, empty anchor link
-    tags, or xhtml2pdf specific tags.
+    Wrap the text of a <pre> tag to width with wrap_pre_text, across any tags
+    inside it such as <code> or <span>. Line breaks go in the text they
+    follow, and <br> tags count as line endings. Comments are left alone.
     """
-    emptymatches = re.compile('^(&nbsp;|\s|\n|\r|\t)*$')
-    emptytags = soup.findAll(lambda tag: tag.find(True) is None and (tag.string is None or tag.string.strip()=="" or tag.string.strip()==emptymatches) and not tag.isSelfClosing and not (tag.name=='a' and tag.name) and tag.name[0:3] != 'pdf')
-    if emptytags and (len(emptytags) != 0):
-        for t in emptytags: t.extract()
-        #recursive in case removing empty tag creates new empty tag
-        strip_empty_tags(soup)
-    return soup
+    from bs4 import NavigableString
+
+    # The text nodes, and None for each <br>, with their text joined
+    nodes = []
+    texts = []
+    for node in pre.descendants:
+        if type(node) is NavigableString:
+            nodes.append(node)
+            texts.append(unicode(node))
+        elif getattr(node, 'name', None) == 'br':
+            nodes.append(None)
+            texts.append('\n')
+    if not nodes:
+        return
+
+    ends = []
+    n = 0
+    for t in texts:
+        n += len(t)
+        ends.append(n)
+    text = ''.join(texts)
+
+    # Split the output between the nodes the text came from
+    outs = [[] for node in nodes]
+    i = 0
+    for start, end, piece, same in wrap_pre_text(text, width):
+        # Newlines put in between characters go with the one before
+        at = start if end > start else max(start - 1, 0)
+        while ends[i] <= at:
+            i += 1
+        if not same or end <= ends[i]:
+            outs[i].append(piece)
+            continue
+        # An unchanged piece may cross into the next nodes
+        j = i
+        while start < end:
+            stop = min(end, ends[j])
+            outs[j].append(text[start:stop])
+            start = stop
+            j += 1
+
+    for node, t, out in zip(nodes, texts, outs):
+        out = ''.join(out)
+        if node is not None and out != t:
+            node.replace_with(out)
 
 def config_state(config_file, section, state):
     """
@@ -274,33 +1254,456 @@ def config_state(config_file, section, state):
     # update the state with the section dict
     state.update(config_dict)
 
-def main(argv=None):
-    import sys, tempfile, argparse
+class UsageError(Exception):
+    """
+    The options given can't be used. The message is shown to the user.
+    """
+    pass
 
-    # Log to stdout
-    import logging
-    logging.basicConfig()
+def section_state(state, section, config_file=None):
+    """
+    Update state with the options of a run section from ~/.zdf2pdf.cfg and
+    then config_file. Raises UsageError if neither has the section.
+    """
+    section_found = False
+    config_files = [os.path.expanduser('~') + '/.zdf2pdf.cfg']
+    if config_file:
+        config_files.append(config_file)
 
-    # Declare a class for an argparse custom action.
-    # Handles converting ascii input from argparse that may contain unicode
-    # to a real unicode string.
-    class UnicodeStore(argparse.Action):
-        def __call__(self, parser, namespace, values, option_string=None):
-            setattr(namespace, self.dest, values.decode('utf-8'))
+    for path in config_files:
+        if state['verbose']: print('Searching for {} in {}'.format(section, path))
+        try:
+            config_state(path, section, state)
+            section_found = True
+            if state['verbose']: print('Found {} in {}'.format(section, path))
+        except configparser.NoSectionError:
+            # This file did not have this section. Hope it's found later.
+            pass
 
-    # Options precedence:
-    # program state defaults, which are overridden by
-    # ~/.zdf2pdf.cfg [zdf2pdf] section options, which are overridden by
-    # command line options, which are overridden by
-    # -c CONFIG_FILE [zdf2pdf] section options, which are overridden by
-    # ~/.zdf2pdf.cfg [RUN_SECTION] section options, which are overridden by
-    # -c CONFIG_FILE [RUN_SECTION] section options
-    #
-    # Program state, with defaults
-    #
-    state = {
+    # If the section wasn't found, it's an error
+    if not section_found:
+        raise UsageError('Error: Run section {} was not found'.format(section))
+
+def snapshot_state(state):
+    """
+    Update state to make the PDF again from the snapshot in the directory
+    state['from_snapshot'], with the options it was made with and without
+    Zendesk or the network. Options that don't change the PDF, such as the
+    output file and the number of render workers, are left as they are.
+    Returns the manifest of the snapshot. Raises UsageError if the snapshot
+    can't be used.
+    """
+    from .snapshot import read_manifest, SnapshotError, RUN_OPTIONS
+
+    path = os.path.abspath(state['from_snapshot'])
+    if os.path.abspath(state['work_dir']) == path:
+        raise UsageError('Error: Use another working directory to rebuild a snapshot')
+    try:
+        manifest = read_manifest(path)
+    except SnapshotError as e:
+        raise UsageError(e)
+
+    # Options the snapshot was made without were not set
+    keep = RUN_OPTIONS + ['work_dir', 'delete', 'mail', 'password', 'is_token']
+    for k in state.keys():
+        if k not in keep:
+            state[k] = manifest['options'].get(k)
+    state['from_snapshot'] = path
+    state['json_file'] = os.path.join(path, manifest['entries'])
+    if manifest['style_file']:
+        state['style_file'] = os.path.join(path, manifest['style_file'])
+    else:
+        state['style_file'] = None
+    # Without -o, the PDF is written into the new working directory under
+    # the name it had, rather than over the one made before
+    if state['output_file'] == default_state()['output_file']:
+        state['output_file'] = os.path.join(state['work_dir'], manifest['output']['name'])
+    # Rendering in sections starts each top level section on a new page, so
+    # the PDF can't be the same as one rendered the other way
+    chunked = lambda opts: (opts.get('render_workers') or 1) > 1 or bool(opts.get('incremental'))
+    if chunked(state) and not chunked(manifest['options']):
+        print('Warning: The snapshot was rendered in one piece, so the PDF will differ '
+              'with --render-workers or --incremental')
+    elif chunked(manifest['options']) and not chunked(state):
+        print('Warning: The snapshot was rendered in sections, so the PDF will differ '
+              'without --render-workers or --incremental')
+    return manifest
+
+def config_sections(config_file=None):
+    """
+    The names of the run sections in ~/.zdf2pdf.cfg and config_file.
+    """
+    sections = []
+    for path in [os.path.expanduser('~') + '/.zdf2pdf.cfg', config_file]:
+        if path:
+            config = configparser.SafeConfigParser()
+            config.read(path)
+            sections += [s for s in config.sections()
+                         if s != 'zdf2pdf' and s not in sections]
+    return sections
+
+def check_state(state):
+    """
+    Handle any last minute type checking or setting once all config options
+    are in. Raises UsageError for options that can't be used.
+    """
+    for k in ['pre_width', 'fetch_workers', 'api_workers', 'render_workers',
+              'batch_workers', 'attach_cache_size', 'attach_cache_age',
+              'image_max_width', 'image_quality']:
+        if state[k]:
+            try:
+                state[k] = int(state[k])
+            except (TypeError, ValueError):
+                raise UsageError('Could not convert {} {} to integer'.format(k, repr(state[k])))
+
+    if state['image_quality'] and not 1 <= state['image_quality'] <= 95:
+        raise UsageError('Error: Image quality must be from 1 to 95')
+
+    if state['image_max_width'] or state['image_quality'] or state['image_grayscale']:
+        try:
+            import PIL
+        except ImportError:
+            raise UsageError('Error: The image options need PIL or Pillow installed')
+
+    if state['html_parser'] and state['html_parser'] not in ['html.parser', 'lxml', 'html5lib']:
+        raise UsageError('Error: Unknown HTML parser {}'.format(state['html_parser']))
+    if state['html_parser'] in ['lxml', 'html5lib']:
+        try:
+            __import__(state['html_parser'])
+        except ImportError:
+            raise UsageError('Error: HTML parser {} is not installed'.format(state['html_parser']))
+
+def zendesk(state, memo=None):
+    """
+    Return a ZendeskAPI configured by state, or None if the state does not
+    need Zendesk. memo is passed on to ZendeskAPI. Raises UsageError if
+    Zendesk is needed but not configured.
+    """
+    if not (state['categories'] or state['topics'] or state['forums'] or state['list_zdf']):
+        return None
+
+    from .api import ZendeskAPI, EntryCache
+    if state['url'] and state['mail'] and state['password']:
+        if state['verbose']:
+            print('Configuring Zendesk with:\n'
+                  'url: {}\n'
+                  'mail: {}\n'
+                  'password: (hidden)\n'
+                  'is_token: {}\n'.format( state['url'], state['mail'],
+                                         repr(state['is_token']) ))
+        # Keep the topics received in the working directory so that
+        # later runs only need to get what has changed
+        cache = EntryCache(os.path.join(os.path.abspath(state['work_dir']),
+                                        'entry-cache'))
+        return ZendeskAPI(state['url'], state['mail'], state['password'],
+                          state['is_token'], cache=cache, memo=memo)
+
+    raise UsageError(textwrap.dedent("""\
+        Error: Need Zendesk config for requested operation. Use -u, -m,
+               -p options or a config file to provide the information.
+
+        Config file (e.g. ~/.zdf2pdf.cfg) should be something like:
+        [zdf2pdf]
+        url = https://example.zendesk.com
+        mail = you@example.com
+        password = dneib393fwEF3ifbsEXAMPLEdhb93dw343
+        is_token = 1
+        """))
+
+def gather_entries(zd, state):
+    """
+    Return an iterator over the entries from each of the inputs given by
+    state. Entries that have been used are not kept. Raises UsageError if the
+    inputs can't be used or give no entries.
+    """
+    # Entries are gathered from each of the inputs as iterables of entries.
+    # Topics from Zendesk are still arriving when these are chained together
+    # and handed to zdf2pdf, which uses them as they come in.
+    entries = []
+
+    # Entries not chosen by the selection options are dropped as they come
+    # in, before any HTML is made from them
+    select = entry_filter(state)
+    def selected(items):
+        return select.entries(items) if select else items
+
+    # Use an entries file on disk
+    if state['json_file']:
+        if state['verbose']: print('Reading entries from {}'.format(state['json_file']))
+        # Get the entries off disk as they are needed
+        entries.append(selected(read_entries(state['json_file'])))
+
+    # Use an entries store made by zdf2pdf fetch
+    if state['store']:
+        from .store import EntryStore, StoreError
+        if state['verbose']: print('Reading entries from store {}'.format(state['store']))
+        try:
+            stored = EntryStore(state['store']).read()
+        except StoreError as e:
+            raise UsageError('{}'.format(e))
+        # Relative links and images are on the Zendesk the entries came from
+        if not state['url']:
+            state['url'] = stored['info'].get('url')
+        # Entries are chosen from the tree, so the bodies of the others
+        # aren't read at all
+        tree = select.tree(stored['entries']) if select else stored['entries']
+        entries.append(EntryStore(state['store']).entries(tree))
+
+    # Get the entries from one or more zendesk categories and forums
+    if state['categories'] or state['forums']:
+        try:
+            cat_ids = [int(i) for i in state['categories'].split(',')] if state['categories'] else []
+        except ValueError:
+            raise UsageError('Error: Could not convert to integers: {}'.format(state['categories']))
+
+        try:
+            forum_ids = [int(i) for i in state['forums'].split(',')] if state['forums'] else []
+        except ValueError:
+            raise UsageError('Error: Could not convert to integers: {}'.format(state['forums']))
+
+        entries.append(selected(harvest(zd, cat_ids, forum_ids, state, state['api_workers'])))
+
+    # Get individual entries from zendesk
+    if state['topics']:
+        topic_ids = [i for i in state['topics'].replace(' ', '').split(',') if i]
+        topics = zd.show_topics(topic_ids)
+        if state['topics_heading']:
+            entries.append(selected([{'section': state['topics_heading'],
+                                      'id': 'topics',
+                                      'body': '',
+                                      'topics': topics}]))
+        else:
+            entries.append(selected(topics))
+
+    entries = itertools.chain.from_iterable(entries)
+
+    try:
+        first = next(entries)
+    except StopIteration:
+        # Didn't get entries from any inputs.
+        if select:
+            raise UsageError("Error: None of the entries received were selected.")
+        raise UsageError("Error: Did not receive any entries.")
+
+    return _put_back(first, entries)
+
+def _put_back(first, entries):
+    # Yield first and then the rest of entries. Unlike chaining [first] on,
+    # first isn't kept once the next entry is asked for.
+    yield first
+    del first
+    for entry in entries:
+        yield entry
+
+def entry_filter(state):
+    """
+    The EntryFilter for the selection options of state. Raises UsageError if
+    they can't be used.
+    """
+    from .selection import EntryFilter, OPTIONS
+
+    try:
+        return EntryFilter(**dict((k, state[k]) for k in OPTIONS))
+    except ValueError as e:
+        raise UsageError('Error: {}'.format(e))
+
+def list_forums(zd, workers=1):
+    """
+    Print every category by ID and name, each followed by its forums,
+    indented. The forums of up to workers categories are looked up at once,
+    starting as soon as each category is received, and every category is
+    printed once it and those before it are done.
+    """
+    import sys, collections
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(max(workers, 1))
+    pending = collections.deque()
+
+    def show(done_only):
+        while pending and (not done_only or pending[0][1].ready()):
+            cat, forums = pending.popleft()
+            print('{} {}'.format(cat['id'], cat['name']))
+            for forum in forums.get():
+                print('    {} {}'.format(forum['id'], forum['name']))
+            sys.stdout.flush()
+
+    try:
+        for cat in zd.list_categories():
+            pending.append((cat, pool.apply_async(list, (zd.list_category_forums(cat['id']),))))
+            show(True)
+        show(False)
+    finally:
+        pool.close()
+        pool.join()
+
+def list_entries(zd, forum_id):
+    """
+    Print the entries of a forum by ID and title, a page at a time as they
+    are received.
+    """
+    for entry in zd.list_topics(forum_id):
+        print('{} {}'.format(entry['id'], entry['title']))
+
+def profiler(state):
+    """
+    A Profiler for the run, profiling the stage asked for by state.
+    """
+    from .profiling import Profiler
+    return Profiler(state['profile_stage'])
+
+def build(entries, zd, state, profiler=None):
+    """
+    Make the PDF for state from entries, and clean up after. The profile of
+    the run is saved and shown if asked for.
+    """
+    zdf2pdf(entries, state, profiler)
+
+    if state['verbose']:
+        from .profiling import peak_rss
+        print('Peak memory: {:.1f} MB'.format(peak_rss() / 1048576.0))
+
+    if state['verbose'] and zd:
+        print('Entry cache: {} topics unchanged, {} new or updated'.format(
+              zd.cache.unchanged, zd.cache.changed))
+
+    if profiler and (state['profile'] or state['profile_stage']):
+        profiler.write(state['work_dir'])
+        if state['profile']:
+            print('{:<20} {:>9} {:>9}  {}'.format('Stage', 'Seconds', 'Peak MB', 'Counts'))
+            for stage in profiler.stages:
+                print('{:<20} {:>9.3f} {:>9.1f}  {}'.format(stage['name'], stage['seconds'],
+                      stage['peak_rss'] / 1048576.0,
+                      ', '.join('{} {}'.format(k, v) for k, v in sorted(stage['counts'].items()))))
+
+    if state['delete']:
+        shutil.rmtree(state['work_dir'])
+
+def consume(entries):
+    """
+    Pull in every entry of entries and the sections inside it. The topics of
+    sections that can only be iterated over once are made EntryStreams, so
+    they can still be used once pulled in.
+    """
+    for entry in entries:
+        if entry.has_key('topics'):
+            if not isinstance(entry['topics'], list):
+                entry['topics'] = EntryStream(entry['topics'])
+            consume(entry['topics'])
+
+def _build_section(results, name, entries, zd, state, prof):
+    # Runs in a batch process
+    start = time.time()
+    try:
+        build(entries, zd, state, prof)
+        error = None
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        error = 'Error: {}'.format(e)
+    results.put((name, error, time.time() - start))
+
+def batch(base_state, sections, config_file=None):
+    """
+    Build the run sections named by the comma separated string sections, or
+    all run sections in the config files if it is empty, starting with the
+    program state base_state.
+
+    Sections are fetched one at a time, sharing a memo of everything
+    received from Zendesk so that forums and topics used by several sections
+    are only requested once. Each section is then built in a process of its
+    own while the next is being fetched, with up to batch_workers building
+    at once. Sections that would share a working directory are each built in
+    a directory named after them inside it. Prints a summary of every
+    section once done. Returns the exit status for main.
+    """
+    import copy, multiprocessing
+    # Loaded once here rather than in every process
+    import bs4, xhtml2pdf.pisa
+
+    sections = [s.strip() for s in sections.split(',') if s.strip()] or config_sections(config_file)
+    if not sections:
+        print('Error: No run sections found')
+        return 1
+
+    try:
+        check_state(base_state)
+    except UsageError as e:
+        print(e)
+        return 1
+
+    # Sections building at once in one working directory would write over
+    # each other's files and render caches
+    work_dirs = {}
+    for name in sections:
+        state = dict(base_state, verbose=False)
+        try:
+            section_state(state, name, config_file)
+        except UsageError:
+            continue
+        work_dirs.setdefault(os.path.abspath(state['work_dir']), []).append(name)
+    shared = set(name for names in work_dirs.itervalues() if len(names) > 1
+                 for name in names)
+
+    memo = {}
+    results = multiprocessing.Queue()
+    status = dict((name, ['waiting', 0.0, 0.0]) for name in sections)
+    running = {}
+
+    def collect():
+        # Wait for a build to finish
+        name, error, seconds = results.get()
+        running.pop(name).join()
+        status[name][0] = error or 'ok'
+        status[name][2] = seconds
+
+    for name in sections:
+        state = copy.deepcopy(base_state)
+        start = time.time()
+        try:
+            section_state(state, name, config_file)
+            if name in shared:
+                state['work_dir'] = os.path.join(state['work_dir'], name)
+            check_state(state)
+            prof = profiler(state)
+            with prof.stage('fetch'):
+                zd = zendesk(state, memo)
+                entries = EntryStream(gather_entries(zd, state))
+                consume(entries)
+        except Exception as e:
+            status[name][0] = '{}'.format(e).strip().split('\n')[0]
+            continue
+        finally:
+            status[name][1] = time.time() - start
+
+        while len(running) >= (base_state['batch_workers'] or 1):
+            collect()
+        if base_state['verbose']: print('Building {}'.format(name))
+        running[name] = multiprocessing.Process(target=_build_section,
+                                                args=(results, name, entries, zd, state, prof))
+        running[name].start()
+
+    while running:
+        collect()
+
+    width = max(len(name) for name in sections + ['Section'])
+    print('{:<{}}  {:>8}  {:>8}  {}'.format('Section', width, 'Fetch', 'Build', 'Status'))
+    for name in sections:
+        error, fetch, built = status[name]
+        print('{:<{}}  {:>7.1f}s  {:>7.1f}s  {}'.format(name, width, fetch, built, error))
+
+    return 0 if all(status[name][0] == 'ok' for name in sections) else 1
+
+def default_state():
+    """
+    The program state, with the default of every option.
+    """
+    import tempfile
+
+    return {
         'verbose': False,
         'json_file': None,
+        'store': None,
         'categories': None,
         'forums': None,
         'topics': None,
@@ -318,11 +1721,34 @@ def main(argv=None):
         'toc_title': 'Table of Contents',
         'pre_width': None,
         'strip_empty': False,
+        'transforms': None,
+        'html_parser': None,
+        'fetch_workers': 4,
+        'api_workers': 4,
+        'render_workers': 1,
+        'incremental': False,
+        'batch_workers': 4,
+        'profile': False,
+        'profile_stage': None,
+        'from_snapshot': None,
+        'reproducible': False,
+        'low_memory': False,
+        'attach_cache': os.path.join(tempfile.gettempdir(), 'zdf2pdf-attach-cache'),
+        'attach_cache_size': 1024,
+        'attach_cache_age': 90,
+        'image_max_width': None,
+        'image_quality': None,
+        'image_grayscale': False,
         'header': None,
         'footer': None,
         'category_sections': False,
         'forum_sections': False,
         'topics_heading': None,
+        'tags': None,
+        'updated_after': None,
+        'updated_before': None,
+        'title_match': None,
+        'exclude': None,
         'work_dir': tempfile.gettempdir(),
         'delete': False,
         'url': None,
@@ -331,13 +1757,121 @@ def main(argv=None):
         'is_token': False,
     }
 
-    argp = argparse.ArgumentParser(
+def unicode_store():
+    """
+    An argparse custom action. Handles converting ascii input from argparse
+    that may contain unicode to a real unicode string.
+    """
+    import argparse
+
+    class UnicodeStore(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            setattr(namespace, self.dest, values.decode('utf-8'))
+    return UnicodeStore
+
+def zendesk_arguments(argp):
+    """
+    Add the options for the config file and reaching Zendesk to the argparse
+    parser argp of a subcommand.
+    """
+    UnicodeStore = unicode_store()
+    argp.add_argument('-v', '--verbose', action='store_true',
+        help='Verbose output')
+    argp.add_argument('-c', action=UnicodeStore, dest='config_file',
+        help='Configuration file (overrides ~/.zdf2pdf.cfg)')
+    argp.add_argument('--api-workers', action=UnicodeStore, dest='api_workers',
+        help='Number of Zendesk requests to make at once (default: 4)')
+    argp.add_argument('-u', action=UnicodeStore, dest='url',
+        help='URL of Zendesk (e.g. https://example.zendesk.com)')
+    argp.add_argument('-m', action=UnicodeStore, dest='mail',
+        help='E-Mail address for Zendesk login')
+    argp.add_argument('-p', action=UnicodeStore, dest='password',
+        help='Password for Zendesk login',
+        nargs='?', const='prompt')
+    argp.add_argument('-i', '--is-token', action='store_true', dest='is_token',
+        help='Is token? Specify if password supplied a Zendesk token')
+
+def command_state(argp, argv):
+    """
+    Parse the command line arguments argv of a subcommand with the argparse
+    parser argp. Returns the program state and the parsed arguments.
+
+    Options precedence is as for making a PDF:
+    program state defaults, which are overridden by
+    ~/.zdf2pdf.cfg [zdf2pdf] section options, which are overridden by
+    command line options, which are overridden by
+    -c CONFIG_FILE [zdf2pdf] section options
+    """
+    state = default_state()
+    try:
+        config_state(os.path.expanduser('~') + '/.zdf2pdf.cfg', 'zdf2pdf', state)
+    except configparser.NoSectionError:
+        pass
+
+    # Options the subcommand doesn't take keep the value of the state
+    argp.set_defaults(**dict((k, v) for k, v in state.iteritems()
+                             if k != 'list_zdf' and (k != 'password' or v != 'prompt')))
+    args = argp.parse_args(argv)
+    for k in state.keys():
+        state[k] = getattr(args, k, None)
+
+    if args.config_file:
+        if state['verbose']: print('Reading config file {}'.format(args.config_file))
+        try:
+            config_state(args.config_file, 'zdf2pdf', state)
+        except configparser.NoSectionError:
+            pass
+    return (state, args)
+
+# Subcommands, by the module and function that run them. Each imports only
+# what it needs, rather than everything making a PDF does.
+COMMANDS = {
+    'list': ('listing', 'main'),
+    'fetch': ('store', 'fetch_main'),
+    'render': ('store', 'render_main'),
+    'serve': ('serve', 'main'),
+}
+
+def main(argv=None):
+    import sys, argparse
+
+    if argv is None:
+        argv = sys.argv
+
+    # Run a subcommand instead
+    if len(argv) > 1 and argv[1] in COMMANDS:
+        import importlib
+        module, func = COMMANDS[argv[1]]
+        command = importlib.import_module('.' + module, __package__)
+        return getattr(command, func)(argv[2:])
+
+    # Log to stdout
+    import logging
+    logging.basicConfig()
+
+    UnicodeStore = unicode_store()
+
+    # Options precedence:
+    # program state defaults, which are overridden by
+    # ~/.zdf2pdf.cfg [zdf2pdf] section options, which are overridden by
+    # command line options, which are overridden by
+    # -c CONFIG_FILE [zdf2pdf] section options, which are overridden by
+    # ~/.zdf2pdf.cfg [RUN_SECTION] section options, which are overridden by
+    # -c CONFIG_FILE [RUN_SECTION] section options
+    #
+    # Program state, with defaults
+    #
+    state = default_state()
+
+    argp = argparse.ArgumentParser(prog=os.path.basename(argv[0]) or None,
         description='Make a PDF from Zendesk forums or entries.')
     argp.add_argument('-v', '--verbose', action='store_true',
         help='Verbose output')
 
     argp.add_argument('--json-file', action=UnicodeStore, dest='json_file',
         help='Zendesk entries JSON file to convert to PDF')
+    argp.add_argument('--store', action=UnicodeStore, dest='store',
+        help='Entries store made by zdf2pdf fetch to convert to PDF (see docs)')
     argp.add_argument('--categories', action=UnicodeStore, dest='categories',
         help='Comma separated Category IDs to download and convert to PDF')
     argp.add_argument('--forums', action=UnicodeStore, dest='forums',
@@ -346,6 +1880,12 @@ def main(argv=None):
         help='Comma separated Topic (Entry) IDs to download and convert to PDF')
     argp.add_argument('-r', action=UnicodeStore, dest='run_section',
         help='Run pre-configured section in configuration file')
+    argp.add_argument('--batch', action=UnicodeStore, dest='batch',
+        help='''Build comma separated run sections, or all run sections in the
+        configuration files if none are given, in one process''',
+        nargs='?', const='', metavar='RUN_SECTIONS')
+    argp.add_argument('--batch-workers', action=UnicodeStore, dest='batch_workers',
+        help='Number of run sections to build at once in batch mode (default: 4)')
     argp.add_argument('-l', action=UnicodeStore, dest='list_zdf',
         help="""List a forum's entries by ID and title.  If no forum ID is
         supplied, list forums by ID and title organized by category""",
@@ -379,6 +1919,55 @@ def main(argv=None):
         help='Width to wrap contents of <pre></pre> tags.')
     argp.add_argument('--strip-empty', action='store_true', dest='strip_empty',
         help='Strip empty tags. (default: false)')
+    argp.add_argument('--html-parser', action=UnicodeStore, dest='html_parser',
+        help='''HTML parser to use: html.parser, lxml, or html5lib
+        (default: lxml if installed, otherwise html.parser)''')
+    argp.add_argument('--transforms', action=UnicodeStore, dest='transforms',
+        help='''Comma separated module.ClassName custom transforms to apply
+        to the HTML (see docs)''')
+    argp.add_argument('--fetch-workers', action=UnicodeStore, dest='fetch_workers',
+        help='Number of images to download at once (default: 4)')
+    argp.add_argument('--attach-cache', action=UnicodeStore, dest='attach_cache',
+        help='''Directory in which to cache downloaded images, may be shared
+        by run sections and working directories (default: temp dir)''')
+    argp.add_argument('--attach-cache-size', action=UnicodeStore,
+        dest='attach_cache_size',
+        help='Maximum size of the image cache in MB (default: 1024)')
+    argp.add_argument('--attach-cache-age', action=UnicodeStore,
+        dest='attach_cache_age',
+        help='Days an unused image is kept in the image cache (default: 90)')
+    argp.add_argument('--image-max-width', action=UnicodeStore,
+        dest='image_max_width',
+        help='''Scale images down to this many pixels wide, keeping the size
+        they are shown at (default: no limit)''')
+    argp.add_argument('--image-quality', action=UnicodeStore,
+        dest='image_quality',
+        help='JPEG quality, 1 to 95, to save images with (default: 85)')
+    argp.add_argument('--image-grayscale', action='store_true',
+        dest='image_grayscale',
+        help='Make images grey (default: false)')
+    argp.add_argument('--render-workers', action=UnicodeStore,
+        dest='render_workers',
+        help='''Number of processes to render the PDF with. More than one
+        renders each top level section separately (default: 1)''')
+    argp.add_argument('--incremental', action='store_true', dest='incremental',
+        help='''Keep each rendered top level section in the working directory
+        and only render sections that have changed (default: false)''')
+    argp.add_argument('--profile', action='store_true', dest='profile',
+        help='''Show the time, peak memory, and counts of each stage of the
+        run, and save them to profile.json in the working directory''')
+    argp.add_argument('--profile-stage', action=UnicodeStore, dest='profile_stage',
+        help='''Run a stage under cProfile and save the statistics to
+        STAGE.prof in the working directory (see docs)''')
+    argp.add_argument('--from-snapshot', action=UnicodeStore, dest='from_snapshot',
+        help='''Make the PDF again, offline, from the working directory of an
+        earlier run (see docs)''')
+    argp.add_argument('--reproducible', action='store_true', dest='reproducible',
+        help='''Make the same PDF, byte for byte, from the same input
+        (default: false)''')
+    argp.add_argument('--low-memory', action='store_true', dest='low_memory',
+        help='''Keep as little of the document in memory at once as possible,
+        going through files in the working directory (default: false)''')
     argp.add_argument('--header', action=UnicodeStore, dest='header',
         help='HTML header to add to the PDF (see docs)')
     argp.add_argument('--footer', action=UnicodeStore, dest='footer',
@@ -393,6 +1982,19 @@ def main(argv=None):
         dest='topics_heading',
         help='Heading to put at start of topics retrieved individually')
 
+    argp.add_argument('--tags', action=UnicodeStore, dest='tags',
+        help='Comma separated tags, only entries with one of them are included')
+    argp.add_argument('--updated-after', action=UnicodeStore, dest='updated_after',
+        help='''Only include entries updated on or after this date,
+        YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ''')
+    argp.add_argument('--updated-before', action=UnicodeStore, dest='updated_before',
+        help='''Only include entries updated before this date, YYYY-MM-DD or
+        YYYY-MM-DDTHH:MM:SSZ''')
+    argp.add_argument('--title-match', action=UnicodeStore, dest='title_match',
+        help='Only include entries whose title matches this regular expression')
+    argp.add_argument('--exclude', action=UnicodeStore, dest='exclude',
+        help='Comma separated Topic (Entry) IDs to leave out')
+
     argp.add_argument('-w', action=UnicodeStore, dest='work_dir',
         help="""Working directory in which to store JSON output and images
         (default: temp dir)""")
@@ -400,6 +2002,9 @@ def main(argv=None):
         help="""Delete working directory at program exit
         (default: do not delete)""")
 
+    argp.add_argument('--api-workers', action=UnicodeStore, dest='api_workers',
+        help='Number of Zendesk requests to make at once (default: 4)')
+
     argp.add_argument('-u', action=UnicodeStore, dest='url',
         help='URL of Zendesk (e.g. https://example.zendesk.com)')
     argp.add_argument('-m', action=UnicodeStore, dest='mail',
@@ -427,9 +2032,7 @@ def main(argv=None):
         pass
 
     # Parse the command line options
-    if argv is None:
-        argv = sys.argv
-    args = argp.parse_args()
+    args = argp.parse_args(argv[1:])
 
     # Update the program state with command line options
     for k in state.keys():
@@ -444,71 +2047,22 @@ def main(argv=None):
             # -c CONFIG_FILE did not have a [zdf2pdf] section. Skip it.
             pass
 
-    # -r RUN_SECTION given
-    if args.run_section:
-        if state['verbose']: print('Searching for {} in ~/.zdf2pdf'.format(args.run_section))
-        section_found = False
-        try:
-            config_state(os.path.expanduser('~') + '/.zdf2pdf.cfg', args.run_section, state)
-            section_found = True
-            if state['verbose']: print('Found {} in ~/.zdf2pdf'.format(args.run_section))
-        except configparser.NoSectionError:
-            # ~/.zdf2pdf.cfg did not have this section. Hope it's found later.
-            pass
+    # Build each run section given to --batch in this process
+    if args.batch is not None:
+        return batch(state, args.batch, args.config_file)
 
-        # -c CONFIG_FILE and -r RUN_SECTION given
-        if args.config_file:
-            if state['verbose']: print('Searching for {} in {}'.format(args.run_section, args.config_file))
-            try:
-                config_state(args.config_file, args.run_section, state)
-                section_found = True
-                if state['verbose']: print('Found {} in {}'.format(args.run_section, args.config_file))
-            except configparser.NoSectionError:
-                # CONFIG_FILE did not have this section.
-                pass
-
-        # If the section wasn't found, print an error and exit
-        if not section_found:
-            print('Error: Run section {} was not found'.format(args.run_section))
-            return 1
-
-    if state['categories'] or state['topics'] or state['forums'] or state['list_zdf']:
-        from zendesk import Zendesk
-        if state['url'] and state['mail'] and state['password']:
-            if state['verbose']:
-                print('Configuring Zendesk with:\n'
-                      'url: {}\n'
-                      'mail: {}\n'
-                      'password: (hidden)\n'
-                      'is_token: {}\n'.format( state['url'], state['mail'],
-                                             repr(state['is_token']) ))
-            zd = Zendesk(state['url'],
-                        zendesk_username = state['mail'],
-                        zendesk_password = state['password'],
-                        use_api_token = state['is_token'])
-        else:
-            msg = textwrap.dedent("""\
-                Error: Need Zendesk config for requested operation. Use -u, -m,
-                       -p options or a config file to provide the information.
-
-                Config file (e.g. ~/.zdf2pdf.cfg) should be something like:
-                [zdf2pdf]
-                url = https://example.zendesk.com
-                mail = you@example.com
-                password = dneib393fwEF3ifbsEXAMPLEdhb93dw343
-                is_token = 1
-                """)
-            print(msg)
-            return 1
-
-    # All config options are in, state is set.
-    # Handle any last minute type checking or setting
-    if state['pre_width']:
-        try:
-            state['pre_width'] = int(state['pre_width'])
-        except TypeError:
-            print('Could not convert pre_width {} to integer'.format( repr(state['pre_width']) ))
-            return 1
+    # -r RUN_SECTION given
+    try:
+        if args.run_section:
+            section_state(state, args.run_section, args.config_file)
+        manifest = None
+        if state['from_snapshot']:
+            manifest = snapshot_state(state)
+        zd = zendesk(state)
+        check_state(state)
+    except UsageError as e:
+        print(e)
+        return 1
 
     # Log the state
     if state['verbose']:
@@ -524,12 +2078,7 @@ def main(argv=None):
         #     54321 Forum 2 name
         # 67890 Category 2 name
         if state['verbose']: print('Listing all forums')
-        categories = zd.list_categories()
-        for cat in categories['categories']:
-            print('{} {}'.format(cat['id'], cat['name']))
-            forums = zd.list_category_forums(category_id=cat['id'])['forums']
-            for forum in forums:
-                print('    {} {}'.format(forum['id'], forum['name']))
+        list_forums(zd, state['api_workers'])
         return 0
 
     elif state['list_zdf']:
@@ -541,157 +2090,25 @@ def main(argv=None):
             print('Error: Could not convert to integer: {}'.format(state['list_zdf']))
             return 1
 
-        entries = zd.list_topics(forum_id=state['list_zdf'])
-        for entry in entries['topics']:
-            print('{} {}'.format(entry['id'], entry['title']))
+        list_entries(zd, forum_id)
         return 0
 
-    # Use an entries file on disk
-    if state['json_file']:
-        if state['verbose']: print('Reading entries from {}'.format(state['json_file']))
-        # Get the entries off disk
-        with open(state['json_file'], 'r') as infile:
-            entries = json.loads(infile.read())
-    else:
-        entries = []
-
-    # Get the entries from one or more zendesk categories
-    if state['categories']:
-
-        try:
-            cat_ids = [int(i) for i in state['categories'].split(',')]
-        except ValueError:
-            print('Error: Could not convert to integers: {}'.format(state['forums']))
-            return 1
-
-        for cat_id in cat_ids:
-            if state['verbose']: 
-                print('Obtaining entries from category {}'.format(cat_id))
-
-            cat_entries = []
-            forums = zd.list_category_forums(category_id=cat_id)['forums']
-            for forum in forums:
-                if state['verbose']: 
-                    print('Obtaining entries from forum {}'.format(forum['id']))
-
-                # topics = [{entry}, {entry}, ..., {entry}]
-                topics = zd.list_topics(forum_id=forum['id'])['topics']
-
-                if state['forum_sections']:
-                    cat_entries.append({'section': forum['name'],
-                                        'id': forum['id'],
-                                        'body': forum['description'],
-                                        'topics': topics})
-                    # result:
-                    # cat_entries = [
-                    #                 <previous forums,>
-                    #                 {
-                    #                   'section':'FORUM TITLE',
-                    #                   'topics':
-                    #                     [
-                    #                       {entry},
-                    #                       ...
-                    #                       {entry}
-                    #                     ]
-                    #                 }
-                    #               ]
-                else:
-                    cat_entries += topics
-                    # result:
-                    # cat_entries = [ 
-                    #                 {entry},
-                    #                 ...
-                    #                 {entry}
-                    #               ]
-
-            if state['category_sections']:
-                cat = zd.show_category(category_id=cat_id)
-                entries.append({'section': cat['name'],
-                                'id': cat_id,
-                                'body': cat['description'],
-                                'topics': cat_entries})
-                #od[zd.show_category(category_id=cat_id)['name']] = 
-                #entries.append([zd.show_category(category_id=cat_id)['name']] = 
-                # result if forum sections:
-                # entries = [
-                #             <previous categories,>
-                #             {
-                #               'section': 'CATEGORY TITLE',
-                #               'id': 'CATEGORY ID',
-                #               'body': 'CATEGORY DESCRIPTION',
-                #               'topics':
-                #                 [
-                #                   {
-                #                     'section':'FORUM TITLE',
-                #                     'topics':
-                #                       [
-                #                         {entry},
-                #                         ...
-                #                         {entry}
-                #                       ]
-                #                   }
-                #                 ]
-                #             }
-                #           ]
-                #
-                # result if not forum sections:
-                # entries = [
-                #             <previous categories,>
-                #             {
-                #               'section':'CATEGORY TITLE',
-                #               'topics':
-                #                 [
-                #                   {entry},
-                #                   ...
-                #                   {entry}
-                #                 ]
-                #             }
-                #           ]
-            else:
-                entries += cat_entries
-                # result: whatever cat_entries was (forums as sections or not)
-                #         is concatenated onto the end of entries
-
-    # Get the entries from one or more zendesk forums
-    if state['forums']:
-        try:
-            forum_ids = [int(i) for i in state['forums'].split(',')]
-            for forum_id in forum_ids:
-                if state['verbose']: 
-                    print('Obtaining entries from forum {}'.format(forum_id))
-                topics = zd.list_topics(forum_id=forum_id)['topics']
-                # see above for description of what entries looks like
-                if state['forum_sections']:
-                    forum = zd.show_forum(forum_id=forum_id)['forum']
-                    entries.append({'section': forum['name'],
-                                    'id': forum['id'],
-                                    'body': forum['description'],
-                                    'topics':topics})
-                else:
-                    entries += topics
-
-        except ValueError:
-            print('Error: Could not convert to integers: {}'.format(state['forums']))
-            return 1
-
-    # Get individual entries from zendesk
-    if state['topics']:
-        topic_ids = state['topics'].replace(' ', '')
-        topics = zd.show_multiple_topics(topic_ids)['topics']
-        if state['entries_heading']:
-            entries.append({'section':state['entries_heading'], 'topics':topics})
-        else:
-            entries += topics
-
-    if len(entries) == 0:
-        # Didn't get entries from any inputs.
-        print("Error: Did not receive any entries.")
+    prof = profiler(state)
+    try:
+        with prof.stage('fetch'):
+            entries = gather_entries(zd, state)
+    except UsageError as e:
+        print(e)
         return 1
 
-    zdf2pdf(entries, state)
-
-    if state['delete']:
-        shutil.rmtree(state['work_dir'])
+    build(entries, zd, state, prof)
 
+    if manifest:
+        from .snapshot import file_sha1
+        if file_sha1(state['output_file']) == manifest['output']['sha1']:
+            print('{} is the same as the snapshot'.format(state['output_file']))
+        else:
+            print('{} differs from the snapshot{}'.format(state['output_file'],
+                  '' if state['reproducible'] else ', which was not made with --reproducible'))
+            return 1
     return 0
-